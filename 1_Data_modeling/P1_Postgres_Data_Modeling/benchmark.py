@@ -0,0 +1,119 @@
+import io
+import time
+import functools
+import contextlib
+import create_tables
+from etl import *
+
+
+def count_rows(cur):
+    """Count the rows loaded in all the tables of the star schema
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+
+    Returns:
+        int: total number of rows in songplays, users, songs, artists and time
+
+    """
+    total = 0
+    for table in ("songplays", "users", "songs", "artists", "time"):
+        cur.execute("SELECT COUNT(*) FROM {}".format(table))
+        total += cur.fetchone()[0]
+    return total
+
+
+def log_loader(cur, func):
+    """Bind to a log file function the lookups built once per run, as etl.main does
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        func (function): process_log_file or process_log_file_bulk
+
+    Returns:
+        function: func with its song index
+
+    """
+    return functools.partial(func, song_index=load_song_index(cur))
+
+
+def load_row_by_row(cur, conn, policy=None):
+    process_data(cur, conn, filepath='data/song_data', func=process_song_file, policy=policy)
+    process_data(cur, conn, filepath='data/log_data', 
+                 func=log_loader(cur, process_log_file), policy=policy)
+
+
+def load_bulk(cur, conn, policy=None):
+    create_staging_tables(cur)
+    process_data(cur, conn, filepath='data/song_data', func=process_song_file_bulk, policy=policy)
+    process_data(cur, conn, filepath='data/log_data', 
+                 func=log_loader(cur, process_log_file_bulk), policy=policy)
+
+
+def load_bulk_deferred(cur, conn):
+    create_tables.prepare_bulk_load(cur, conn)
+    load_bulk(cur, conn)
+    create_tables.finish_bulk_load(cur, conn)
+
+
+def load_bulk_parallel(cur, conn, workers=4):
+    process_data_parallel('data/song_data', process_song_file_bulk, workers, bulk=True)
+    process_data_parallel('data/log_data', 
+                          log_loader(cur, process_log_file_bulk), 
+                          workers, bulk=True)
+
+
+def load_song_batches(cur, conn, batch_size=1000):
+    create_staging_tables(cur)
+    process_song_data_batched(cur, conn, 'data/song_data', batch_size)
+    process_data(cur, conn, filepath='data/log_data', 
+                 func=log_loader(cur, process_log_file_bulk))
+
+
+def run_benchmark(load):
+    """Load the bundled data tree into a fresh sparkifydb and time it
+
+    The database is dropped and created again before the load, so
+    every run starts from empty tables.
+
+    Args:
+        load (function): function that loads the data, given a cursor and a connection
+
+    Returns:
+        tuple: number of rows loaded and elapsed seconds
+
+    """
+    cur, conn = create_tables.create_database()
+    create_tables.create_tables(cur, conn)
+    create_tables.create_constraints(cur, conn)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        load(cur, conn)
+    elapsed = time.perf_counter() - start
+
+    rows = count_rows(cur)
+    conn.close()
+    return rows, elapsed
+
+
+BENCHMARKS = [
+    ("row by row", load_row_by_row),
+    ("row by row, commit/50", functools.partial(load_row_by_row, policy=CommitPolicy(files=50))),
+    ("bulk COPY", load_bulk),
+    ("bulk COPY, commit/50", functools.partial(load_bulk, policy=CommitPolicy(files=50))),
+    ("bulk COPY, deferred FKs", load_bulk_deferred),
+    ("bulk COPY, 4 workers", load_bulk_parallel),
+    ("song file batches", load_song_batches),
+]
+
+
+def main():
+    print("{:<24} {:>10} {:>10} {:>12}".format("mode", "rows", "seconds", "rows/sec"))
+    for name, load in BENCHMARKS:
+        rows, elapsed = run_benchmark(load)
+        print("{:<24} {:>10} {:>10.2f} {:>12.0f}".format(name, rows, elapsed, rows / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
+import argparse
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import (create_table_queries, drop_table_queries, 
+                         add_constraint_queries, validate_constraint_queries, drop_constraint_queries)
 
 
 def create_database():
@@ -34,11 +36,86 @@ def create_tables(cur, conn):
         conn.commit()
 
 
+def create_constraints(cur, conn):
+    """Add the foreign keys of the star schema and validate the existing rows
+
+    The foreign keys are added as NOT VALID, which is instant, and then
+    validated with a single scan of each table instead of row by row checks.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        conn (psycopg2.extensions.connection): database connection
+
+    """
+    for query in drop_constraint_queries + add_constraint_queries + validate_constraint_queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def drop_constraints(cur, conn):
+    """Drop the foreign keys of the star schema
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        conn (psycopg2.extensions.connection): database connection
+
+    """
+    for query in drop_constraint_queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def prepare_bulk_load(cur, conn):
+    """Drop the foreign keys before a large load
+
+    The rows loaded afterwards pay no foreign key checks, the primary keys
+    are kept. finish_bulk_load has to run once the load is done.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        conn (psycopg2.extensions.connection): database connection
+
+    """
+    drop_constraints(cur, conn)
+
+
+def finish_bulk_load(cur, conn):
+    """Add again and validate the foreign keys dropped by prepare_bulk_load
+
+    Raises psycopg2.IntegrityError if the rows loaded break a foreign key.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        conn (psycopg2.extensions.connection): database connection
+
+    """
+    create_constraints(cur, conn)
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Create the sparkifydb database and its tables")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--before-load", action="store_true",
+                       help="only drop the foreign keys of the existing database")
+    group.add_argument("--after-load", action="store_true",
+                       help="only add again and validate the foreign keys")
+    args = parser.parse_args()
+
+    if args.before_load or args.after_load:
+        conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+        cur = conn.cursor()
+        if args.before_load:
+            prepare_bulk_load(cur, conn)
+        else:
+            finish_bulk_load(cur, conn)
+        conn.close()
+        return
+
     cur, conn = create_database()
     
     drop_tables(cur, conn)
     create_tables(cur, conn)
+    create_constraints(cur, conn)
 
     conn.close()
 
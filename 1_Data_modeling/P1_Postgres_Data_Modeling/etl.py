@@ -1,8 +1,27 @@
 import os
+import io
 import glob
+import hashlib
+import json
+import random
+import time
+import argparse
+import functools
+import multiprocessing
 import psycopg2
 import pandas as pd
+from psycopg2.extras import execute_values
 from sql_queries import *
+from create_tables import prepare_bulk_load, finish_bulk_load
+from manifest import create_manifest_table, get_pending_files, record_loaded_files, record_failed_files
+
+
+SPARKIFY_DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+# times a file rolled back by a deadlock with a concurrent load is tried again,
+# after a random wait of up to DEADLOCK_BACKOFF seconds, doubled on every retry
+DEADLOCK_RETRIES = 5
+DEADLOCK_BACKOFF = 0.1
 
 
 def process_song_file(cur, filepath):
@@ -16,6 +35,9 @@ def process_song_file(cur, filepath):
         cur (psycopg2.extensions.cursor): database cursor
         filepath (str): filepath of a song file
 
+    Returns:
+        int: number of song records in the file
+
     """
     
     # open song file
@@ -38,9 +60,201 @@ def process_song_file(cur, filepath):
                     "duration"]].values[0].tolist()
     
     cur.execute(song_table_insert, song_data)
+
+    return len(df)
     
 
-def process_log_file(cur, filepath):
+def read_log_events(filepath, chunksize=None):
+    """Read the NextSong events of a log file
+
+    Without chunksize the file is read at once with pandas. With chunksize
+    the file is streamed line by line, and only the NextSong events are 
+    kept and turned into frames of at most chunksize rows, so the memory
+    used does not depend on the size of the file.
+
+    Args:
+        filepath (str): filepath of a log file
+        chunksize (int): maximum number of events of each frame
+
+    Yields:
+        pandas.DataFrame: NextSong events
+
+    """
+    if not chunksize:
+        df = pd.read_json(filepath, lines=True)
+        yield df[df['page']=='NextSong']
+        return
+
+    events = []
+    with open(filepath) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event.get('page') != 'NextSong':
+                continue
+            events.append(event)
+            if len(events) == chunksize:
+                yield pd.DataFrame(events)
+                events = []
+
+    if events:
+        yield pd.DataFrame(events)
+
+
+def load_time_keys(cur, first_ts, last_ts):
+    """Get the timestamps already loaded in the time table between two timestamps
+
+    Only the range of the events being loaded is read, so the cost does
+    not grow with the history in the table. The rows loaded earlier in
+    the same transaction are seen too.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        first_ts (int): first timestamp of the range, in milliseconds
+        last_ts (int): last timestamp of the range, in milliseconds
+
+    Returns:
+        set: timestamps of the time table in the range, in milliseconds since epoch like the "ts" of the logs
+
+    """
+    cur.execute(time_keys_select, (pd.to_datetime(first_ts, unit='ms').to_pydatetime(), 
+                                   pd.to_datetime(last_ts, unit='ms').to_pydatetime()))
+    return {ts for ts, in cur.fetchall()}
+
+
+def extract_time_data(df, loaded_times=None):
+    """Break down the timestamps of the log events into time units
+
+    The time units are computed with vectorized datetime accessors, only
+    once for each distinct timestamp.
+
+    Args:
+        df (pandas.DataFrame): log events with the "ts" column in milliseconds
+        loaded_times (set): timestamps already loaded, in milliseconds. They are 
+            left out of the result
+
+    Returns:
+        pandas.DataFrame: one row per new timestamp with the columns of the time table
+
+    """
+    ts = df['ts'].drop_duplicates()
+    if loaded_times is not None:
+        ts = ts[~ts.isin(loaded_times)]
+
+    # sorted so concurrent loads lock rows in the same order
+    t = pd.to_datetime(ts.sort_values(), unit='ms')
+
+    return pd.DataFrame({'start_time': t,
+                         'hour': t.dt.hour,
+                         'day': t.dt.day,
+                         'week': t.dt.isocalendar().week.astype(int),
+                         'month': t.dt.month,
+                         'year': t.dt.year,
+                         'weekday': t.dt.dayofweek})
+
+
+def extract_user_data(df):
+    """Get the user records of the log events
+
+    Args:
+        df (pandas.DataFrame): NextSong log events
+
+    Returns:
+        pandas.DataFrame: one row per user with the columns of the users table
+
+    """
+    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    user_df = user_df.astype({'userId': int})
+
+    # the last event of each user sets its level, as the row by row upsert did.
+    # Rows are sorted by key so concurrent loads lock them in the same order
+    user_df = user_df.drop_duplicates('userId', keep='last')
+    return user_df.sort_values('userId')
+
+
+def load_song_index(cur):
+    """Build the in-memory lookup of the songs already loaded in the database
+
+    The index is a hash table keyed by (title, artist name, duration), the
+    fields an event names its song by, so the song and artist ids of a whole
+    log file can be resolved with a single pandas merge instead of one 
+    query per event. It has to be built again after loading new song files.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+
+    Returns:
+        pandas.DataFrame: song_id and artist_id indexed by (song, artist, length)
+
+    """
+    cur.execute(song_index_select)
+    song_index = pd.DataFrame(cur.fetchall(), 
+                              columns=['song', 'artist', 'length', 'song_id', 'artist_id'])
+    # typed like the events it is merged with, also when no song is loaded yet
+    song_index['length'] = song_index['length'].astype(float)
+
+    # an event matches a single song, as the row by row lookup kept its first match
+    song_index = song_index.drop_duplicates(['song', 'artist', 'length'])
+    return song_index.set_index(['song', 'artist', 'length'])
+
+
+def songplay_key(session_id, ts, user_id, item_in_session):
+    """Build the id of a songplay from the attributes that identify its event
+
+    The id does not depend on the file, the order or the way the event
+    is loaded, so loading the same event again always finds the same row.
+
+    Args:
+        session_id (int): id of the session
+        ts (int): timestamp of the event in milliseconds
+        user_id (int): id of the user
+        item_in_session (int): position of the event in the session
+
+    Returns:
+        str: md5 hex digest of the attributes
+
+    """
+    key = '{}|{}|{}|{}'.format(session_id, ts, user_id, item_in_session)
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def extract_songplay_data(df, song_index):
+    """Build the songplay records of the log events
+
+    Args:
+        df (pandas.DataFrame): NextSong log events
+        song_index (pandas.DataFrame): lookup built by load_song_index
+
+    Returns:
+        pandas.DataFrame: one row per event with the columns of the songplays table,
+            song_id and artist_id are None for the songs not found in the index
+
+    """
+    ids = df[['song', 'artist', 'length']].merge(song_index, 
+                                                 how='left',
+                                                 left_on=['song', 'artist', 'length'],
+                                                 right_index=True)
+
+    songplay_ids = [songplay_key(*event) for event in zip(df['sessionId'], 
+                                                          df['ts'], 
+                                                          df['userId'].astype(int), 
+                                                          df['itemInSession'])]
+
+    songplay_df = pd.DataFrame({'songplay_id': songplay_ids,
+                                'start_time': pd.to_datetime(df['ts'], unit='ms'),
+                                'user_id': df['userId'],
+                                'level': df['level'],
+                                'song_id': ids['song_id'],
+                                'artist_id': ids['artist_id'],
+                                'session_id': df['sessionId'],
+                                'location': df['location'],
+                                'user_agent': df['userAgent']})
+
+    return songplay_df.astype(object).where(songplay_df.notnull(), None)
+
+
+def process_log_file(cur, filepath, song_index=None, chunksize=None):
     """Extract data from a log file and load it into a database
 
     This function gets info about the users events presents in the log file filepath,
@@ -50,66 +264,512 @@ def process_log_file(cur, filepath):
     Args:
         cur (psycopg2.extensions.cursor): database cursor
         filepath (str): filepath of a log file
+        song_index (pandas.DataFrame): lookup built by load_song_index, 
+            it is built from the database when not given
+        chunksize (int): read the file in chunks of at most this many NextSong events,
+            so memory stays bounded whatever the file size. The whole file is read at once
+            when not given
+
+    Returns:
+        int: number of NextSong events in the file
 
     """    
-    # open log file
-    df = pd.read_json(filepath, lines=True)
+    return load_log_file(cur, filepath, load_log_data, insert_users, song_index, chunksize)
 
-    # filter by NextSong action
-    df = df[df['page']=='NextSong']
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df['ts'], unit='ms')
-    
-    # insert time data records
-    
-    time_data = [[mt, 
-                  mt.hour, 
-                  mt.day, 
-                  mt.week, 
-                  mt.month, 
-                  mt.year, 
-                  mt.dayofweek] for mt in t]
+def load_log_file(cur, filepath, load_data, load_users, song_index, chunksize):
+    """Load the NextSong events of a log file, whole or in chunks
 
-    column_labels = ('start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday')
-    time_df = pd.DataFrame(time_data, columns=column_labels)
+    When the file is streamed in chunks, each chunk only adds the users
+    that do not exist yet, which takes no lock on the existing ones. The
+    latest record of every user of the file is then upserted once, in a
+    single statement sorted by key, so concurrent loads lock users in the
+    same order and do not deadlock.
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        filepath (str): filepath of a log file
+        load_data (function): load_log_data or load_log_data_bulk
+        load_users (function): insert_users or merge_users
+        song_index (pandas.DataFrame): lookup built by load_song_index, 
+            it is built from the database when None
+        chunksize (int): read the file in chunks of at most this many NextSong events
 
-    # load user table
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    Returns:
+        int: number of NextSong events in the file
 
-    # insert user records
+    """
+    # get songid and artistid of every event from the song index
+    if song_index is None:
+        song_index = load_song_index(cur)
+
+    num_events, file_users = 0, None
+    for df in read_log_events(filepath, chunksize):
+        load_data(cur, df, song_index, update_users=not chunksize)
+        num_events += len(df)
+        if chunksize:
+            file_users = pd.concat([file_users, extract_user_data(df)])
+            file_users = file_users.drop_duplicates('userId', keep='last')
+
+    if file_users is not None:
+        load_users(cur, file_users.sort_values('userId'))
+
+    return num_events
+
+
+def insert_users(cur, user_df, update=True):
+    """Insert user records row by row
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        user_df (pandas.DataFrame): one row per user with the columns of the users table
+        update (bool): update the users that already exist, instead of leaving them as they are
+
+    """
+    query = user_table_insert if update else user_table_insert_new
     for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+        cur.execute(query, list(row))
+
+
+def load_log_data(cur, df, song_index, update_users=True):
+    """Insert the time, users and songplays records of NextSong events row by row
+
+    The timestamps of the events already in the time table are looked up
+    in the range of the events only, and left out.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        df (pandas.DataFrame): NextSong log events
+        song_index (pandas.DataFrame): lookup built by load_song_index
+        update_users (bool): update the users that already exist, see insert_users
+
+    """
+    # insert time data records
+    loaded_times = load_time_keys(cur, df['ts'].min(), df['ts'].max()) if len(df) else set()
+    time_df = extract_time_data(df, loaded_times)
+
+    if len(time_df):
+        execute_values(cur, time_table_insert_values, time_df.itertuples(index=False, name=None),
+                       page_size=len(time_df))
+
+    # insert user records
+    insert_users(cur, extract_user_data(df), update_users)
+
+    # get songid and artistid of every event from the song index
+    songplay_df = extract_songplay_data(df, song_index)
 
     # insert songplay records
-    for index, row in df.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
+    for i, row in songplay_df.iterrows():
+        cur.execute(songplay_table_insert, list(row))
+
+
+def create_staging_tables(cur):
+    """Create the temporary staging tables used by the bulk load
+
+    Temporary tables live as long as the connection of the cursor cur,
+    so this has to run once per connection before any bulk load.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+
+    """
+    for query in create_staging_queries:
+        cur.execute(query)
+
+
+def copy_dataframe(cur, df, table):
+    """Stream the rows of a DataFrame into a table with COPY FROM STDIN
+
+    The rows are serialized into an in-memory CSV buffer, so no temporary
+    file is written. The DataFrame columns must follow the column order 
+    of the table.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        df (pandas.DataFrame): rows to copy
+        table (str): name of the destination table
+
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cur.copy_expert(staging_copy.format(table), buffer)
+
+
+def merge_dataframe(cur, df, staging_table, merge_query):
+    """Copy a DataFrame into a staging table and merge it into its final table
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        df (pandas.DataFrame): rows to load, at most one per key of the final table
+        staging_table (str): name of the staging table
+        merge_query (str): set-based upsert from the staging table
+
+    """
+    copy_dataframe(cur, df, staging_table)
+    cur.execute(merge_query)
+    cur.execute(staging_truncate.format(staging_table))
+
+
+def process_song_file_bulk(cur, filepath):
+    """Bulk version of process_song_file
+
+    Loads the artists and songs of the file filepath through the staging
+    tables with COPY and one set-based upsert per table, instead of one
+    INSERT per record.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        filepath (str): filepath of a song file
+
+    Returns:
+        int: number of song records in the file
+
+    """
+    df = pd.read_json(filepath, lines=True)
+    load_song_data(cur, df)
+
+    return len(df)
+
+
+def load_song_data(cur, df):
+    """Load song records into the artists and songs tables through the staging tables
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        df (pandas.DataFrame): song records, as read from the song files
+
+    """
+    # artists are updated on conflict, so the last record of each artist wins
+    artist_df = df[["artist_id", 
+                    "artist_name",
+                    "artist_location", 
+                    "artist_latitude", 
+                    "artist_longitude"]].drop_duplicates("artist_id", keep="last")
+    merge_dataframe(cur, artist_df, "artist_staging", artist_table_merge)
+
+    # songs are never updated, so the first record of each song wins
+    song_df = df[["song_id", 
+                  "title", 
+                  "artist_id", 
+                  "year", 
+                  "duration"]].drop_duplicates("song_id", keep="first")
+    merge_dataframe(cur, song_df, "song_staging", song_table_merge)
+
+
+def read_json_files(filepaths):
+    """Read many JSON lines files with a single parse
+
+    The raw lines of all the files are concatenated in memory and parsed
+    at once, instead of paying a pd.read_json call for every small file.
+
+    Args:
+        filepaths (list): filepaths of JSON lines files
+
+    Returns:
+        pandas.DataFrame: the records of all the files, in order
+
+    """
+    lines = []
+    for filepath in filepaths:
+        with open(filepath) as f:
+            content = f.read().strip()
+        if content:
+            lines.append(content)
+    return pd.read_json(io.StringIO('\n'.join(lines)), lines=True)
+
+
+def load_song_batch(cur, batch, manifest=False):
+    """Load a batch of song files inside a savepoint
+
+    When the batch fails, as it does when one of its files is malformed,
+    it is rolled back and its files are loaded again one by one with
+    load_file, so only the files that fail are left out.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        batch (list): filepaths of the song files
+        manifest (bool): record each file in the load manifest
+
+    Returns:
+        tuple: number of rows loaded, and filepath and error message of 
+        each file, None when it was loaded
+
+    """
+    cur.execute(file_savepoint)
+    try:
+        df = read_json_files(batch)
+        load_song_data(cur, df)
+        if manifest:
+            record_loaded_files(cur, batch)
+    except Exception:
+        cur.execute(file_savepoint_rollback)
+    else:
+        cur.execute(file_savepoint_release)
+        return len(df), [(datafile, None) for datafile in batch]
+
+    rows, results = 0, []
+    for datafile in batch:
+        file_rows, error = load_file(cur, datafile, process_song_file_bulk, manifest)
+        rows += file_rows
+        results.append((datafile, error))
+    return rows, results
+
+
+def process_song_data_batched(cur, conn, filepath, batch_size, manifest=False, policy=None):
+    """Load the song files in batches
+
+    Every batch of files is read with a single parse, deduplicated in memory
+    and loaded with one COPY and one upsert per table, inside a savepoint,
+    see load_song_batch. Batches are committed as the policy says, counting
+    the files and rows of every batch. The staging tables of the bulk load 
+    have to exist in the connection.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        conn (psycopg2.extensions.connection): database connection
+        filepath (str): directory with the song files
+        batch_size (int): number of files loaded in each batch
+        manifest (bool): skip the files already loaded and record the new ones in the load manifest
+        policy (CommitPolicy): when to commit, after every batch by default
+
+    Returns:
+        list: filepath and error message of the files that failed
+
+    """
+    all_files = get_files(filepath)
+    print('{} files found in {}'.format(len(all_files), filepath))
+
+    if manifest:
+        all_files = get_pending_files(cur, all_files)
+        print('{} files not loaded yet'.format(len(all_files)))
+    num_files = len(all_files)
+
+    policy = policy or CommitPolicy()
+    pending_files, pending_rows, failures = 0, 0, []
+    start = last_commit = time.perf_counter()
+    for i in range(0, num_files, batch_size):
+        batch = all_files[i:i + batch_size]
+        rows, results = load_song_batch(cur, batch, manifest)
+
+        pending_files += len(batch)
+        pending_rows += rows
+        if policy.due(pending_files, pending_rows, time.perf_counter() - last_commit):
+            conn.commit()
+            pending_files, pending_rows = 0, 0
+            last_commit = time.perf_counter()
+
+        for j, (datafile, error) in enumerate(results, i + 1):
+            report_file(j, num_files, datafile, error, failures)
+    conn.commit()
+
+    elapsed = time.perf_counter() - start
+    print('{} files loaded in {:.2f} seconds ({:.0f} files/sec).'.format(
+        num_files, elapsed, num_files / elapsed if elapsed else 0))
+    if failures:
+        print('{} of {} files failed.'.format(len(failures), num_files))
+    return failures
+
+
+def process_log_file_bulk(cur, filepath, song_index=None, chunksize=None):
+    """Bulk version of process_log_file
+
+    Loads the time, users and songplays records of the log file filepath
+    through the staging tables with COPY and one set-based upsert per table.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        filepath (str): filepath of a log file
+        song_index (pandas.DataFrame): lookup built by load_song_index, 
+            it is built from the database when not given
+        chunksize (int): read the file in chunks of at most this many NextSong events,
+            so memory stays bounded whatever the file size. The whole file is read at once
+            when not given
+
+    Returns:
+        int: number of NextSong events in the file
+
+    """
+    return load_log_file(cur, filepath, load_log_data_bulk, merge_users, song_index, chunksize)
+
+
+def merge_users(cur, user_df, update=True):
+    """Load user records through the staging table
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        user_df (pandas.DataFrame): one row per user with the columns of the users table
+        update (bool): update the users that already exist, instead of leaving them as they are
+
+    """
+    merge_query = user_table_merge if update else user_table_merge_new
+    merge_dataframe(cur, user_df, "user_staging", merge_query)
+
+
+def load_log_data_bulk(cur, df, song_index, update_users=True):
+    """Load the time, users and songplays records of NextSong events through the staging tables
+
+    The time records are generated in the database from the songplays
+    staged, before they are merged, see time_table_generate.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        df (pandas.DataFrame): NextSong log events
+        song_index (pandas.DataFrame): lookup built by load_song_index
+        update_users (bool): update the users that already exist, see merge_users
+
+    """
+    # load user records
+    merge_users(cur, extract_user_data(df), update_users)
+
+    # load time and songplay records
+    songplay_df = extract_songplay_data(df, song_index)
+    merge_dataframe(cur, songplay_df, "songplay_staging", time_table_generate + songplay_table_merge)
+
+
+def get_files(filepath):
+    """Get all the json files under a directory
+
+    Args:
+        filepath (str): directory with raw data
+
+    Returns:
+        list: absolute paths of the json files found
+
+    """
+    all_files = []
+    for root, dirs, files in os.walk(filepath):
+        files = glob.glob(os.path.join(root,'*.json'))
+        for f in files :
+            all_files.append(os.path.abspath(f))
+    return all_files
+
+
+class CommitPolicy:
+    """When to commit while loading a sequence of files
+
+    A commit happens as soon as any of the limits set is reached, and
+    always after the last file. A limit of None or 0 is not set. Files 
+    are loaded inside savepoints, so a file that fails is rolled back 
+    alone and the rest of the transaction is kept.
+
+    Args:
+        files (int): commit every this many files
+        rows (int): commit every this many rows loaded
+        seconds (float): commit every this many seconds
+
+    """
+
+    def __init__(self, files=1, rows=None, seconds=None):
+        self.files = files
+        self.rows = rows
+        self.seconds = seconds
+
+    def due(self, files, rows, seconds):
+        """Check if the transaction has to be committed
+
+        Args:
+            files (int): files loaded since the last commit
+            rows (int): rows loaded since the last commit
+            seconds (float): seconds since the last commit
+
+        Returns:
+            bool: True when any of the limits is reached
+
+        """
+        return bool((self.files and files >= self.files) or
+                    (self.rows and rows >= self.rows) or
+                    (self.seconds and seconds >= self.seconds))
+
+
+def load_file(cur, datafile, func, manifest=False, retries=DEADLOCK_RETRIES):
+    """Load a file inside a savepoint
+
+    Any error rolls back the file only. When the error is a deadlock or a
+    serialization failure with a concurrent load, the file is tried again
+    after a random backoff.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        datafile (str): filepath of the file to load
+        func (function): function to process the file, returning the number of rows loaded
+        manifest (bool): record the file in the load manifest
+        retries (int): number of times a file rolled back by a deadlock is tried again
+
+    Returns:
+        tuple: number of rows loaded and error message, None when the file was loaded
+
+    """
+    for attempt in range(retries + 1):
+        cur.execute(file_savepoint)
+        try:
+            rows = func(cur, datafile) or 0
+            if manifest:
+                record_loaded_files(cur, [datafile])
+        except psycopg2.extensions.TransactionRollbackError as e:
+            cur.execute(file_savepoint_rollback)
+            error = e
+            # random and growing wait, so the loads that collided do not collide again
+            time.sleep(random.uniform(0, DEADLOCK_BACKOFF * 2 ** attempt))
+        except Exception as e:
+            cur.execute(file_savepoint_rollback)
+            error = e
+            break
         else:
-            songid, artistid = None, None
-
-        # insert songplay record
-        songplay_data = (index, 
-                         pd.to_datetime(row.ts, unit='ms'), 
-                         row.userId, 
-                         row.level, 
-                         songid, 
-                         artistid, 
-                         row.sessionId,
-                         row.location, 
-                         row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
-
-
-def process_data(cur, conn, filepath, func):
+            cur.execute(file_savepoint_release)
+            return rows, None
+
+    if manifest:
+        record_failed_files(cur, [datafile])
+    return 0, '{}: {}'.format(type(error).__name__, error)
+
+
+def load_files(cur, conn, files, func, policy, manifest=False):
+    """Load files one by one inside savepoints, committing as the policy says
+
+    Any error raised while a file is loaded rolls back that file only, see
+    load_file. The file is recorded as failed in the manifest, if used, so
+    the next run tries it again.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        conn (psycopg2.extensions.connection): database connection
+        files (list): filepaths of the files to load
+        func (function): function to process each file, returning the number of rows loaded
+        policy (CommitPolicy): when to commit
+        manifest (bool): record each file in the load manifest
+
+    Yields:
+        tuple: filepath and error message, None when the file was loaded
+
+    """
+    pending_files, pending_rows = 0, 0
+    last_commit = time.perf_counter()
+
+    for datafile in files:
+        rows, error = load_file(cur, datafile, func, manifest)
+
+        pending_files += 1
+        pending_rows += rows
+        if policy.due(pending_files, pending_rows, time.perf_counter() - last_commit):
+            conn.commit()
+            pending_files, pending_rows = 0, 0
+            last_commit = time.perf_counter()
+
+        yield datafile, error
+
+    conn.commit()
+
+
+def report_file(i, num_files, datafile, error, failures):
+    """Print the progress of a load and keep track of the files that failed"""
+    if error:
+        failures.append((datafile, error))
+        print('{} failed: {}'.format(datafile, error))
+    print('{}/{} files processed.'.format(i, num_files))
+
+
+def process_data(cur, conn, filepath, func, manifest=False, policy=None):
     """Gets a file with raw data and apply the requiered function to process it
 
     Takes a file with raw data (filepath) and applies the function func on it to process it.
@@ -121,33 +781,189 @@ def process_data(cur, conn, filepath, func):
         conn (psycopg2.extensions.connection): database connection
         filepath (str): filepath to a file with raw data
         func (str): function to process the file filepath
+        manifest (bool): skip the files already loaded and record the new ones in the load manifest
+        policy (CommitPolicy): when to commit, after every file by default
+
+    Returns:
+        list: filepath and error message of the files that failed
 
     """  
     
     # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
+    all_files = get_files(filepath)
+    print('{} files found in {}'.format(len(all_files), filepath))
 
-    # get total number of files found
+    # leave out the files loaded by previous runs
+    if manifest:
+        all_files = get_pending_files(cur, all_files)
+        print('{} files not loaded yet'.format(len(all_files)))
+
+    # get total number of files to process
     num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    # iterate over files and process, committing as the policy says
+    failures = []
+    files = load_files(cur, conn, all_files, func, policy or CommitPolicy(), manifest)
+    for i, (datafile, error) in enumerate(files, 1):
+        report_file(i, num_files, datafile, error, failures)
+
+    if failures:
+        print('{} of {} files failed.'.format(len(failures), num_files))
+    return failures
+
+
+# connection and file processing settings of each worker process
+worker = {}
+
+
+def init_worker(func, bulk, manifest, policy):
+    """Open the database connection of a worker process of process_data_parallel
+
+    Args:
+        func (function): function used by the worker to process each file
+        bulk (bool): create the staging tables of the bulk load in the connection
+        manifest (bool): record each file processed in the load manifest
+        policy (CommitPolicy): when to commit
+
+    """
+    conn = psycopg2.connect(SPARKIFY_DSN)
+    cur = conn.cursor()
+    if bulk:
+        create_staging_tables(cur)
+    worker.update(conn=conn, cur=cur, func=func, manifest=manifest, policy=policy)
+
+
+def process_files_in_worker(files):
+    """Load a chunk of files, in a worker process of process_data_parallel
+
+    Args:
+        files (list): filepaths of the files to process
+
+    Returns:
+        list: filepath and error message of each file, None when it was loaded
+
+    """
+    return list(load_files(worker['cur'], worker['conn'], files, worker['func'], 
+                           worker['policy'], worker['manifest']))
+
+
+def process_data_parallel(filepath, func, workers, bulk=False, manifest=False, policy=None):
+    """Parallel version of process_data
+
+    The files are spread in chunks over a pool of processes, each one with 
+    its own database connection, and every chunk is committed as the policy 
+    says. Progress is reported in the order the files were found. The 
+    function returns once all the files are loaded, so songs can be loaded
+    before the logs that need them.
+
+    Args:
+        filepath (str): filepath to a file with raw data
+        func (function): function to process each file, it has to be picklable
+        workers (int): number of worker processes
+        bulk (bool): func is a bulk load function that needs the staging tables
+        manifest (bool): skip the files already loaded and record the new ones in the load manifest
+        policy (CommitPolicy): when to commit, after every file by default
+
+    Returns:
+        list: filepath and error message of the files that failed
+
+    """
+    all_files = get_files(filepath)
+    print('{} files found in {}'.format(len(all_files), filepath))
+
+    if manifest:
+        conn = psycopg2.connect(SPARKIFY_DSN)
+        all_files = get_pending_files(conn.cursor(), all_files)
         conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+        conn.close()
+        print('{} files not loaded yet'.format(len(all_files)))
+    num_files = len(all_files)
+
+    # a chunk is committed at least once, so it holds the files of a commit
+    policy = policy or CommitPolicy()
+    chunk_size = policy.files or max(1, num_files // (workers * 4))
+    chunks = [all_files[i:i + chunk_size] for i in range(0, num_files, chunk_size)]
+
+    failures = []
+    with multiprocessing.Pool(workers, initializer=init_worker, 
+                              initargs=(func, bulk, manifest, policy)) as pool:
+        i = 0
+        for results in pool.imap(process_files_in_worker, chunks):
+            for datafile, error in results:
+                i += 1
+                report_file(i, num_files, datafile, error, failures)
+
+    if failures:
+        print('{} of {} files failed.'.format(len(failures), num_files))
+    return failures
 
 
 def main():
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    parser = argparse.ArgumentParser(description="Load the Sparkify raw data into sparkifydb")
+    parser.add_argument("--bulk", action="store_true",
+                        help="load each file with COPY into staging tables and set-based upserts")
+    parser.add_argument("--song-batch-size", type=int, default=0,
+                        help="load the song files in batches of this many files, parsed and copied at once")
+    parser.add_argument("--log-chunk-size", type=int,
+                        help="stream the log files in chunks of this many NextSong events")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes loading files in parallel, each with its own connection")
+    parser.add_argument("--commit-files", type=int,
+                        help="commit every this many files, 0 for no limit")
+    parser.add_argument("--commit-rows", type=int,
+                        help="commit every this many rows loaded, 0 for no limit")
+    parser.add_argument("--commit-seconds", type=float,
+                        help="commit every this many seconds, 0 for no limit")
+    parser.add_argument("--defer-constraints", action="store_true",
+                        help="drop the foreign keys during the load, then add and validate them again")
+    parser.add_argument("--reload-all", action="store_true",
+                        help="load every file again, even the ones the load manifest has as loaded")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(SPARKIFY_DSN)
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    # databases created before the manifest existed get it on their first run
+    create_manifest_table(cur)
+    conn.commit()
+    manifest = not args.reload_all
+    # each file is committed on its own unless a limit is given
+    limits = (args.commit_files, args.commit_rows, args.commit_seconds)
+    policy = CommitPolicy(*limits) if any(limit is not None for limit in limits) else CommitPolicy()
+
+    if args.defer_constraints:
+        prepare_bulk_load(cur, conn)
+
+    if args.bulk or args.song_batch_size:
+        create_staging_tables(cur)
+
+    if args.bulk:
+        song_func, log_func = process_song_file_bulk, process_log_file_bulk
+    else:
+        song_func, log_func = process_song_file, process_log_file
+
+    if args.song_batch_size:
+        process_song_data_batched(cur, conn, 'data/song_data', args.song_batch_size, manifest, policy)
+    elif args.workers > 1:
+        process_data_parallel('data/song_data', song_func, args.workers, args.bulk, manifest, policy)
+    else:
+        process_data(cur, conn, filepath='data/song_data', func=song_func, 
+                     manifest=manifest, policy=policy)
+
+    # the song index is built once, after all the song files are loaded
+    song_index = load_song_index(cur)
+    log_func = functools.partial(log_func, song_index=song_index, chunksize=args.log_chunk_size)
+
+    if args.workers > 1:
+        process_data_parallel('data/log_data', log_func, args.workers, args.bulk, manifest, policy)
+    else:
+        process_data(cur, conn, filepath='data/log_data', func=log_func, 
+                     manifest=manifest, policy=policy)
+
+    if args.defer_constraints:
+        start = time.perf_counter()
+        finish_bulk_load(cur, conn)
+        print('Foreign keys added and validated in {:.2f} seconds.'.format(time.perf_counter() - start))
 
     conn.close()
 
@@ -0,0 +1,109 @@
+import os
+import hashlib
+from psycopg2.extras import execute_values
+from sql_queries import manifest_table_create, manifest_select, manifest_upsert
+
+
+def create_manifest_table(cur):
+    """Create the load manifest if the database does not have it yet
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+
+    """
+    cur.execute(manifest_table_create)
+
+
+def file_md5(filepath):
+    """Compute the md5 hash of the content of a file
+
+    Args:
+        filepath (str): filepath of the file
+
+    Returns:
+        str: hexadecimal md5 digest
+
+    """
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_pending_files(cur, all_files):
+    """Leave out the files already loaded according to the manifest
+
+    A file is skipped when the manifest has it as loaded with the same size
+    and mtime. When only the size or mtime changed, the content hash decides,
+    so files that were just touched or copied are not loaded again. Their
+    size and mtime are updated in the manifest, so the next run skips them
+    without hashing them again. The caller commits the update.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        all_files (list): filepaths found in the raw data directory
+
+    Returns:
+        list: filepaths still to load, in the same order
+
+    """
+    cur.execute(manifest_select)
+    loaded = {filepath: (size, mtime, md5) for filepath, size, mtime, md5 in cur.fetchall()}
+
+    pending, touched = [], []
+    for filepath in all_files:
+        entry = loaded.get(filepath)
+        if entry is not None:
+            stat = os.stat(filepath)
+            if (stat.st_size, stat.st_mtime) == entry[:2]:
+                continue
+            if file_md5(filepath) == entry[2]:
+                touched.append((filepath, stat.st_size, stat.st_mtime, entry[2], 'loaded'))
+                continue
+        pending.append(filepath)
+
+    if touched:
+        execute_values(cur, manifest_upsert, touched)
+    return pending
+
+
+def record_files(cur, filepaths, status):
+    """Record files in the manifest with the given status
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        filepaths (list): filepaths of the files
+        status (str): load status of the files, "loaded" or "failed"
+
+    """
+    rows = []
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        rows.append((filepath, stat.st_size, stat.st_mtime, file_md5(filepath), status))
+    execute_values(cur, manifest_upsert, rows)
+
+
+def record_loaded_files(cur, filepaths):
+    """Mark files as loaded in the manifest
+
+    It has to run in the same transaction that loads the files, so the
+    manifest and the data are committed, or rolled back, together.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        filepaths (list): filepaths of the files loaded
+
+    """
+    record_files(cur, filepaths, 'loaded')
+
+
+def record_failed_files(cur, filepaths):
+    """Mark files as failed in the manifest, so the next run loads them again
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        filepaths (list): filepaths of the files that failed
+
+    """
+    record_files(cur, filepaths, 'failed')
@@ -5,17 +5,18 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+manifest_table_drop = "DROP TABLE IF EXISTS load_manifest"
 
 # CREATE TABLES
 
 songplay_table_create = ("""
     CREATE TABLE IF NOT EXISTS songplays (
-        songplay_id SERIAL PRIMARY KEY, 
-        start_time TIMESTAMP REFERENCES time(start_time), 
-        user_id INT NOT NULL REFERENCES users(user_id), 
+        songplay_id CHAR(32) PRIMARY KEY, 
+        start_time TIMESTAMP, 
+        user_id INT NOT NULL, 
         level VARCHAR(10), 
-        song_id VARCHAR(25) REFERENCES songs(song_id), 
-        artist_id VARCHAR(25) REFERENCES artists(artist_id), 
+        song_id VARCHAR(25), 
+        artist_id VARCHAR(25), 
         session_id INT, 
         location VARCHAR(50), 
         user_agent VARCHAR(200)
@@ -36,7 +37,7 @@ song_table_create = ("""
     CREATE TABLE IF NOT EXISTS songs (
         song_id VARCHAR(25) PRIMARY KEY, 
         title VARCHAR(100), 
-        artist_id VARCHAR(25) NOT NULL REFERENCES artists(artist_id), 
+        artist_id VARCHAR(25) NOT NULL, 
         year SMALLINT, 
         duration FLOAT
     )
@@ -64,6 +65,33 @@ time_table_create = ("""
     )
 """)
 
+manifest_table_create = ("""
+    CREATE TABLE IF NOT EXISTS load_manifest (
+        filepath VARCHAR(500) PRIMARY KEY, 
+        size BIGINT, 
+        mtime DOUBLE PRECISION, 
+        md5 CHAR(32), 
+        status VARCHAR(10), 
+        loaded_at TIMESTAMP DEFAULT now()
+    )
+""")
+
+# FOREIGN KEYS
+# Created apart from the tables and with a name, so a bulk load can drop them
+# and add them back afterwards (table, constraint name, definition)
+
+foreign_keys = [
+    ("songs", "songs_artist_id_fkey", "FOREIGN KEY (artist_id) REFERENCES artists(artist_id)"), 
+    ("songplays", "songplays_start_time_fkey", "FOREIGN KEY (start_time) REFERENCES time(start_time)"), 
+    ("songplays", "songplays_user_id_fkey", "FOREIGN KEY (user_id) REFERENCES users(user_id)"), 
+    ("songplays", "songplays_song_id_fkey", "FOREIGN KEY (song_id) REFERENCES songs(song_id)"), 
+    ("songplays", "songplays_artist_id_fkey", "FOREIGN KEY (artist_id) REFERENCES artists(artist_id)")]
+
+# NOT VALID skips checking the existing rows, VALIDATE checks them all in one scan
+constraint_add = "ALTER TABLE {} ADD CONSTRAINT {} {} NOT VALID"
+constraint_validate = "ALTER TABLE {} VALIDATE CONSTRAINT {}"
+constraint_drop = "ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}"
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""
@@ -97,6 +125,17 @@ user_table_insert = ("""
         level=EXCLUDED.level; 
 """)
 
+user_table_insert_new = ("""
+    INSERT INTO users (
+        user_id, 
+        first_name, 
+        last_name, 
+        gender, 
+        level)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT(user_id) DO NOTHING;
+""")
+
 song_table_insert = ("""
     INSERT INTO songs (
         song_id, 
@@ -138,14 +177,223 @@ time_table_insert = ("""
     ON CONFLICT(start_time) DO NOTHING;
 """)
 
+time_table_insert_values = ("""
+    INSERT INTO time (
+        start_time, 
+        hour, 
+        day, 
+        week, 
+        month, 
+        year, 
+        weekday)
+    VALUES %s
+    ON CONFLICT(start_time) DO NOTHING;
+""")
+
 # FIND SONGS
 
-song_select = ("""
-    SELECT song_id, artists.artist_id
+song_index_select = ("""
+    SELECT songs.title, artists.name, songs.duration, song_id, artists.artist_id
     FROM songs JOIN artists ON songs.artist_id = artists.artist_id
-    WHERE songs.title = %s
-    AND artists.name = %s
-    AND songs.duration = %s
+""")
+
+# LOAD MANIFEST
+
+manifest_select = ("""
+    SELECT filepath, size, mtime, md5
+    FROM load_manifest
+    WHERE status = 'loaded'
+""")
+
+manifest_upsert = ("""
+    INSERT INTO load_manifest (
+        filepath, 
+        size, 
+        mtime, 
+        md5, 
+        status)
+    VALUES %s
+    ON CONFLICT(filepath) 
+    DO UPDATE SET 
+        size=EXCLUDED.size, 
+        mtime=EXCLUDED.mtime, 
+        md5=EXCLUDED.md5, 
+        status=EXCLUDED.status, 
+        loaded_at=now();
+""")
+
+# FILE SAVEPOINTS
+# Each file is loaded inside a savepoint, so a failure rolls back that file only
+
+file_savepoint = "SAVEPOINT file_load"
+file_savepoint_release = "RELEASE SAVEPOINT file_load"
+file_savepoint_rollback = "ROLLBACK TO SAVEPOINT file_load"
+
+# FIND LOADED TIMESTAMPS
+
+time_keys_select = ("""
+    SELECT (EXTRACT(EPOCH FROM start_time) * 1000)::BIGINT
+    FROM time
+    WHERE start_time BETWEEN %s AND %s
+""")
+
+# BULK LOAD STAGING TABLES
+# Temporary tables, private to each connection, filled with COPY FROM STDIN
+
+songplay_staging_create = ("""
+    CREATE TEMP TABLE IF NOT EXISTS songplay_staging (
+        songplay_id CHAR(32), 
+        start_time TIMESTAMP, 
+        user_id INT, 
+        level VARCHAR(10), 
+        song_id VARCHAR(25), 
+        artist_id VARCHAR(25), 
+        session_id INT, 
+        location VARCHAR(50), 
+        user_agent VARCHAR(200)
+    )
+""")
+
+user_staging_create = ("""
+    CREATE TEMP TABLE IF NOT EXISTS user_staging (
+        user_id INT, 
+        first_name VARCHAR(50), 
+        last_name VARCHAR(50), 
+        gender CHAR(1), 
+        level VARCHAR(10)
+    )
+""")
+
+song_staging_create = ("""
+    CREATE TEMP TABLE IF NOT EXISTS song_staging (
+        song_id VARCHAR(25), 
+        title VARCHAR(100), 
+        artist_id VARCHAR(25), 
+        year SMALLINT, 
+        duration FLOAT
+    )
+""")
+
+artist_staging_create = ("""
+    CREATE TEMP TABLE IF NOT EXISTS artist_staging (
+        artist_id VARCHAR(25), 
+        name VARCHAR(100), 
+        location VARCHAR(100), 
+        latitude FLOAT, 
+        longitude FLOAT
+    )
+""")
+
+# COPY FROM STDIN (rows come from an in-memory CSV buffer)
+
+staging_copy = "COPY {} FROM STDIN WITH (FORMAT csv)"
+
+staging_truncate = "TRUNCATE {}"
+
+# MERGE STAGING INTO FINAL TABLES
+# Same upsert semantics as the single-row INSERTs above. Rows are
+# deduplicated by key before COPY, so a single statement never
+# touches the same target row twice.
+
+songplay_table_merge = ("""
+    INSERT INTO songplays (
+        songplay_id, 
+        start_time, 
+        user_id, 
+        level, 
+        song_id, 
+        artist_id, 
+        session_id, 
+        location, 
+        user_agent)
+    SELECT songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+    FROM songplay_staging
+    ON CONFLICT(songplay_id) DO NOTHING;
+""")
+
+user_table_merge = ("""
+    INSERT INTO users (
+        user_id, 
+        first_name, 
+        last_name, 
+        gender, 
+        level)
+    SELECT user_id, first_name, last_name, gender, level
+    FROM user_staging
+    ON CONFLICT(user_id) 
+    DO UPDATE SET 
+        first_name=EXCLUDED.first_name, 
+        last_name=EXCLUDED.last_name, 
+        gender=EXCLUDED.gender, 
+        level=EXCLUDED.level; 
+""")
+
+user_table_merge_new = ("""
+    INSERT INTO users (
+        user_id, 
+        first_name, 
+        last_name, 
+        gender, 
+        level)
+    SELECT user_id, first_name, last_name, gender, level
+    FROM user_staging
+    ON CONFLICT(user_id) DO NOTHING;
+""")
+
+song_table_merge = ("""
+    INSERT INTO songs (
+        song_id, 
+        title, 
+        artist_id, 
+        year, 
+        duration)
+    SELECT song_id, title, artist_id, year, duration
+    FROM song_staging
+    ON CONFLICT(song_id) DO NOTHING;
+""")
+
+artist_table_merge = ("""
+    INSERT INTO artists (
+        artist_id, 
+        name, 
+        location, 
+        latitude, 
+        longitude)
+    SELECT artist_id, name, location, latitude, longitude
+    FROM artist_staging
+    ON CONFLICT(artist_id) 
+    DO UPDATE SET 
+        name=EXCLUDED.name, 
+        location=EXCLUDED.location, 
+        latitude=EXCLUDED.latitude, 
+        longitude=EXCLUDED.longitude;
+""")
+
+# Time records of the distinct start times of the songplays staged,
+# generated in the database so the time units are computed once per
+# timestamp and no time rows are copied. Weekday is 0 on Mondays, as
+# in extract_time_data. Sorted so concurrent loads lock rows in the
+# same order.
+
+time_table_generate = ("""
+    INSERT INTO time (
+        start_time, 
+        hour, 
+        day, 
+        week, 
+        month, 
+        year, 
+        weekday)
+    SELECT start_time, 
+        EXTRACT(hour FROM start_time), 
+        EXTRACT(day FROM start_time), 
+        EXTRACT(week FROM start_time), 
+        EXTRACT(month FROM start_time), 
+        EXTRACT(year FROM start_time), 
+        EXTRACT(isodow FROM start_time) - 1
+    FROM (SELECT DISTINCT start_time FROM songplay_staging) new_times
+    ORDER BY start_time
+    ON CONFLICT(start_time) DO NOTHING;
 """)
 
 # QUERY LISTS
@@ -155,11 +403,25 @@ create_table_queries = [
     artist_table_create, 
     song_table_create, 
     time_table_create, 
-    songplay_table_create]
+    songplay_table_create, 
+    manifest_table_create]
 
 drop_table_queries = [
     user_table_drop, 
     artist_table_drop,
     song_table_drop, 
     time_table_drop, 
-    songplay_table_drop]
\ No newline at end of file
+    songplay_table_drop, 
+    manifest_table_drop]
+
+create_staging_queries = [
+    songplay_staging_create, 
+    user_staging_create, 
+    song_staging_create, 
+    artist_staging_create]
+
+add_constraint_queries = [constraint_add.format(*fk) for fk in foreign_keys]
+
+validate_constraint_queries = [constraint_validate.format(table, name) for table, name, _ in foreign_keys]
+
+drop_constraint_queries = [constraint_drop.format(table, name) for table, name, _ in foreign_keys]
@@ -0,0 +1,266 @@
+import re
+import json
+import time
+import argparse
+from sql_queries import create_table_queries, insert_table_queries, insert_table_names
+from sql_queries import explain, table_info_select, analyze_compression, result_cache_off
+from sql_queries import advised_table_create, advised_table_drop
+from connection import connect, read_config
+
+# join steps that move whole tables between the nodes at every run
+FLAGGED_STEPS = ('DS_BCAST_INNER', 'DS_DIST_BOTH')
+# join steps that move one side only, reported without proposals
+REDISTRIBUTION_STEPS = ('DS_DIST_ALL_INNER', 'DS_DIST_INNER', 'DS_DIST_OUTER')
+# tables up to this many rows are cheaper copied to every node than redistributed
+ALL_MAX_ROWS = 1000000
+
+
+def table_columns():
+    """Read the columns of every table from the CREATE TABLE statements
+
+    Returns:
+        dict: lowercase column names of every table, by table name
+
+    """
+    columns = {}
+    for query in create_table_queries:
+        table = re.search(r'CREATE TABLE IF NOT EXISTS (\w+)', query).group(1)
+        body = query[query.index('(') + 1:]
+        columns[table] = [line.split()[0].lower() for line in body.splitlines()
+                          if re.match(r'\s+\w+\s+[A-Z]', line)]
+    return columns
+
+
+def query_tables(query, columns):
+    """Find the tables a statement reads from
+
+    Args:
+        query (str): SQL statement
+        columns (dict): columns of every table, given by table_columns
+
+    Returns:
+        list: names of the tables after FROM and JOIN, in order
+
+    """
+    tables = []
+    for name in re.findall(r'(?:FROM|JOIN)\s+(\w+)', query):
+        if name in columns and name not in tables:
+            tables.append(name)
+    return tables
+
+
+def select_part(query):
+    """Strip the INSERT INTO clause from an INSERT ... SELECT statement
+
+    Args:
+        query (str): INSERT ... SELECT statement
+
+    Returns:
+        str: the SELECT statement that feeds the insert
+
+    """
+    return query[query.index('SELECT'):].rstrip().rstrip(';')
+
+
+def explain_query(cur, query):
+    """Get the plan redshift chooses for a statement
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        query (str): SQL statement
+
+    Returns:
+        list: lines of the plan
+
+    """
+    cur.execute(explain.format(query))
+    return [row[0] for row in cur.fetchall()]
+
+
+def find_joins(plan):
+    """Find the joins of a plan that redistribute or broadcast data
+
+    Args:
+        plan (list): lines of the plan
+
+    Returns:
+        list: tuples with the distribution step, the plan line of the join
+        and the (side, column) pairs of its join condition
+
+    """
+    joins = []
+    for i, line in enumerate(plan):
+        step = next((s for s in FLAGGED_STEPS + REDISTRIBUTION_STEPS if s in line), None)
+        if step is None:
+            continue
+        cond = plan[i + 1] if i + 1 < len(plan) and 'Cond:' in plan[i + 1] else ''
+        joins.append((step, line.strip(), re.findall(r'"(outer|inner)"\.(\w+)', cond)))
+    return joins
+
+
+def column_table(column, tables, columns, exclude=None):
+    """Find which of the tables of a statement has a column
+
+    Args:
+        column (str): lowercase column name
+        tables (list): tables read by the statement
+        columns (dict): columns of every table, given by table_columns
+        exclude (str): table already matched to the other side of the join
+
+    Returns:
+        str: name of the table, None when none of them has the column
+
+    """
+    for table in tables:
+        if table != exclude and column in columns.get(table, []):
+            return table
+    return None
+
+
+def propose(step, keys, tables, columns, rows):
+    """Propose table designs that keep a join local to every node
+
+    A broadcast inner table small enough is proposed with DISTSTYLE ALL.
+    Otherwise both tables are proposed distributed and sorted on their
+    join columns, so matching rows are on the same slice and in order.
+
+    Args:
+        step (str): distribution step of the join
+        keys (list): (side, column) pairs of the join condition, the
+            first pair of each side is used as key
+        tables (list): tables read by the statement
+        columns (dict): columns of every table, given by table_columns
+        rows (dict): number of rows of every table, empty when unknown
+
+    Returns:
+        dict: proposed DISTSTYLE/DISTKEY/SORTKEY clause, by table
+
+    """
+    sides = {}
+    for side, column in keys:
+        sides.setdefault(side, column)
+    if 'outer' not in sides or 'inner' not in sides:
+        return {}
+    inner = column_table(sides['inner'], tables, columns)
+    outer = column_table(sides['outer'], tables, columns, exclude=inner)
+    if inner is None or outer is None:
+        return {}
+    if step == 'DS_BCAST_INNER' and rows.get(inner, ALL_MAX_ROWS) < ALL_MAX_ROWS:
+        return {inner: 'DISTSTYLE ALL'}
+    return {outer: 'DISTKEY({0}) SORTKEY({0})'.format(sides['outer']),
+            inner: 'DISTKEY({0}) SORTKEY({0})'.format(sides['inner'])}
+
+
+def time_query(cur, query):
+    """Run a SELECT statement and time it, without keeping its rows
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        query (str): SELECT statement
+
+    Returns:
+        float: seconds taken by the statement
+
+    """
+    start = time.perf_counter()
+    cur.execute("SELECT COUNT(*) FROM ({}) q".format(query))
+    cur.fetchone()
+    return time.perf_counter() - start
+
+
+def benchmark(cur, query, proposal):
+    """Time a statement against copies of its tables with the proposed designs
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        query (str): INSERT ... SELECT statement
+        proposal (dict): proposed design of the tables, given by propose
+
+    Returns:
+        tuple: seconds taken by the SELECT as it is and with the proposed
+        designs, and the flagged joins left in the plan with them
+
+    """
+    select = select_part(query)
+    before = time_query(cur, select)
+    for table, design in proposal.items():
+        cur.execute(advised_table_create.format(table, design, table))
+    advised = re.sub(r'((?:FROM|JOIN)\s+)({})\b'.format('|'.join(proposal)), r'\1\2_advised', select)
+    after = time_query(cur, advised)
+    remaining = [join for join in find_joins(explain_query(cur, advised)) if join[0] in FLAGGED_STEPS]
+    for table in proposal:
+        cur.execute(advised_table_drop.format(table))
+    return before, after, remaining
+
+
+def print_compression(cur, tables):
+    """Print the column encodings redshift recommends for the tables
+
+    ANALYZE COMPRESSION samples the table under an exclusive lock, so it
+    should run when no load is going on.
+
+    Args:
+        cur (psycopg2.extensions.cursor): database cursor
+        tables (list): names of the tables
+
+    """
+    for table in tables:
+        cur.execute(analyze_compression.format(table))
+        for _, column, encoding, reduction in cur.fetchall():
+            print('    {}.{}: ENCODE {} ({}% smaller)'.format(table, column, encoding, reduction))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--plans', help='analyse the plans saved in this file instead of the cluster')
+    parser.add_argument('--save-plans', help='save the plans of the cluster in this file')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='time every statement against copies of its tables with the proposed designs')
+    parser.add_argument('--compression', action='store_true',
+                        help='print the recommended column encodings of the tables read by the statements')
+    args = parser.parse_args()
+
+    columns = table_columns()
+    cur = conn = None
+    rows, design = {}, {}
+    if args.plans:
+        with open(args.plans) as f:
+            plans = json.load(f)
+    else:
+        conn = connect(read_config())
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute(result_cache_off)
+        cur.execute(table_info_select)
+        for table, diststyle, sortkey, tbl_rows in cur.fetchall():
+            rows[table] = tbl_rows
+            design[table] = '{}, sortkey {}'.format(diststyle, sortkey)
+        plans = {name: explain_query(cur, query) for name, query in zip(insert_table_names, insert_table_queries)}
+        if args.save_plans:
+            with open(args.save_plans, 'w') as f:
+                json.dump(plans, f, indent=4)
+
+    for name, query in zip(insert_table_names, insert_table_queries):
+        tables = query_tables(query, columns)
+        print('{} insert, reading {}'.format(name, ', '.join(
+            '{} ({})'.format(t, design[t]) if t in design else t for t in tables)))
+        for step, line, keys in find_joins(plans.get(name, [])):
+            print('  {}: {}'.format(step, line))
+            if step not in FLAGGED_STEPS:
+                continue
+            proposal = propose(step, keys, tables, columns, rows)
+            for table, clause in proposal.items():
+                print('    proposed {}: {}'.format(table, clause))
+            if args.benchmark and cur is not None and proposal:
+                before, after, remaining = benchmark(cur, query, proposal)
+                print('    {:.1f}s as it is, {:.1f}s with the proposed design, {} flagged joins left'.format(
+                    before, after, len(remaining)))
+        if args.compression and cur is not None:
+            print_compression(cur, tables)
+
+    if conn is not None:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import time
+import random
+import datetime
+import logging
+import threading
+import configparser
+import psycopg2
+from psycopg2.extensions import STATUS_READY
+from telemetry import new_record, split_statements, statement_names, system_tables_available
+from telemetry import statement_ids, statement_bytes
+
+logger = logging.getLogger('dwh')
+
+# errors raised when the connection to the cluster is lost, worth a new try
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+def read_config(path='dwh.cfg'):
+    """Read the configuration of the cluster and the load
+
+    Args:
+        path (str): path of the configuration file
+
+    Returns:
+        configparser.ConfigParser: configuration
+
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def connect_kwargs(config):
+    """Build the arguments of psycopg2.connect from the CLUSTER section
+
+    The keepalives let a long COPY or INSERT notice a dropped connection
+    instead of waiting on it forever.
+
+    Args:
+        config (configparser.ConfigParser): configuration read from dwh.cfg
+
+    Returns:
+        dict: keyword arguments of psycopg2.connect
+
+    """
+    cluster = config['CLUSTER']
+    return {'host': cluster['HOST'],
+            'dbname': cluster['DB_NAME'],
+            'user': cluster['DB_USER'],
+            'password': cluster['DB_PASSWORD'],
+            'port': cluster['DB_PORT'],
+            'connect_timeout': config.getint('ETL', 'CONNECT_TIMEOUT', fallback=30),
+            'keepalives': 1,
+            'keepalives_idle': 60}
+
+
+def set_statement_timeout(conn, config):
+    """Limit how long a statement can run on a connection
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection
+        config (configparser.ConfigParser): configuration read from dwh.cfg
+
+    """
+    with conn.cursor() as cur:
+        cur.execute("SET statement_timeout TO %s",
+                    (config.getint('ETL', 'STATEMENT_TIMEOUT', fallback=7200) * 1000,))
+    conn.commit()
+
+
+def connect(config):
+    """Open a connection to the cluster, with the statement timeout of dwh.cfg
+
+    Args:
+        config (configparser.ConfigParser): configuration read from dwh.cfg
+
+    Returns:
+        psycopg2.extensions.connection: database connection
+
+    """
+    conn = psycopg2.connect(**connect_kwargs(config))
+    set_statement_timeout(conn, config)
+    return conn
+
+
+class ConnectionPool:
+    """Pool of connections to the cluster that runs statements with retries
+
+    Connections are opened when first needed and kept for the next
+    statements; getconn waits when all of them are in use. Every statement
+    runs in its own transaction and its latency is logged.
+    When the connection is lost, the connection is dropped from the pool
+    and an idempotent statement is run again on a new one, after waiting
+    BACKOFF seconds doubled on every try, up to RETRIES times. Statements
+    cancelled by the statement timeout are not tried again.
+    Statements run with stats are recorded in history, with their wall
+    time, rows affected and what the system tables report about them.
+    A step made of several statements runs them one by one in its
+    transaction, and every one of them is recorded and logged.
+
+    Args:
+        config (configparser.ConfigParser): configuration read from dwh.cfg
+        maxconn (int): number of connections that can be used at the same time
+
+    """
+
+    def __init__(self, config, maxconn=1):
+        self.config = config
+        self.maxconn = maxconn
+        self.retries = config.getint('ETL', 'RETRIES', fallback=5)
+        self.backoff = config.getfloat('ETL', 'BACKOFF', fallback=1.0)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self.history = []
+        self.system_tables = None
+
+    def getconn(self):
+        """Take a connection from the pool, opening it when there is no idle one
+
+        Returns:
+            psycopg2.extensions.connection: database connection
+
+        """
+        self._slots.acquire()
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None or conn.closed:
+            try:
+                conn = connect(self.config)
+            except Exception:
+                self._slots.release()
+                raise
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Give a connection back to the pool
+
+        Args:
+            conn (psycopg2.extensions.connection): database connection
+            close (bool): close the connection instead of keeping it, when it is broken
+
+        """
+        if close or conn.closed:
+            conn.close()
+        else:
+            if conn.status != STATUS_READY:
+                conn.rollback()
+            with self._lock:
+                self._idle.append(conn)
+        self._slots.release()
+
+    def execute(self, query, params=None, name=None, idempotent=False, fetch=False, stats=False):
+        """Run a statement in its own transaction and log its latency
+
+        Args:
+            query (str): SQL statement, or statements separated by semicolons
+            params (tuple or dict): parameters of the statement, a dict when
+                a query with several statements is run with stats
+            name (str): name of the statement in the log, its first line by default
+            idempotent (bool): whether the statement can run again after a lost connection
+            fetch (bool): whether to return the rows of the statement, of the last one with stats
+            stats (bool): whether to record the statements in history
+
+        Returns:
+            list: rows of the statement when fetch is set
+
+        """
+        name = name or query.strip().splitlines()[0]
+        statements = split_statements(query) if stats else [query]
+        names = statement_names(name, statements)
+        for attempt in range(self.retries + 1):
+            try:
+                conn = self.getconn()
+            except TRANSIENT_ERRORS as e:
+                if not idempotent or attempt == self.retries:
+                    raise
+                self.wait(name, attempt, e)
+                continue
+            records = []
+            try:
+                if stats and self.system_tables is None:
+                    self.system_tables = system_tables_available(conn)
+                with conn.cursor() as cur:
+                    for statement_name, statement in zip(names, statements):
+                        started_at = datetime.datetime.utcnow()
+                        start = time.perf_counter()
+                        cur.execute(statement, params)
+                        rows = cur.fetchall() if fetch else None
+                        record = new_record(statement_name, started_at, time.perf_counter() - start, cur.rowcount)
+                        if stats and self.system_tables:
+                            record.update(statement_ids(cur, statement))
+                        records.append(record)
+                conn.commit()
+            except psycopg2.errors.QueryCanceled:
+                conn.rollback()
+                self.putconn(conn)
+                raise
+            except TRANSIENT_ERRORS as e:
+                self.putconn(conn, close=True)
+                if not idempotent or attempt == self.retries:
+                    raise
+                self.wait(name, attempt, e)
+                continue
+            except Exception:
+                conn.rollback()
+                self.putconn(conn)
+                raise
+            for record in records:
+                if stats and self.system_tables:
+                    record.update(statement_bytes(conn, record))
+                if record['row_count'] < 0:
+                    logger.info('%s: %.2fs', record['step'], record['seconds'])
+                else:
+                    logger.info('%s: %.2fs, %d rows', record['step'], record['seconds'], record['row_count'])
+            if stats:
+                with self._lock:
+                    self.history.extend(records)
+            self.putconn(conn)
+            return rows
+
+    def wait(self, name, attempt, error):
+        """Wait before the next try of a statement, twice as long every time
+
+        Args:
+            name (str): name of the statement
+            attempt (int): number of the try that failed, from 0
+            error (Exception): error of the try that failed
+
+        """
+        delay = self.backoff * 2 ** attempt * (1 + random.random() / 2)
+        logger.warning('%s: %s, trying again in %.1fs', name, str(error).strip(), delay)
+        time.sleep(delay)
+
+    def closeall(self):
+        """Close the idle connections of the pool"""
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
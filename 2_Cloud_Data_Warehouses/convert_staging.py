@@ -0,0 +1,238 @@
+import os
+import csv
+import glob
+import gzip
+import json
+import time
+import argparse
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sql_queries import staging_tables, csv_copy_queries, parquet_copy_queries
+
+# sample of the raw data bundled with the Postgres project
+P1_DATA = '../1_Data_modeling/P1_Postgres_Data_Modeling/data'
+
+# columns of staging_events and staging_songs, in the order of their CREATE TABLE
+EVENT_COLUMNS = [('artist', 'str'),
+                 ('auth', 'str'),
+                 ('firstName', 'str'),
+                 ('gender', 'str'),
+                 ('itemInSession', 'int'),
+                 ('lastName', 'str'),
+                 ('length', 'float'),
+                 ('level', 'str'),
+                 ('location', 'str'),
+                 ('method', 'str'),
+                 ('page', 'str'),
+                 ('registration', 'float'),
+                 ('sessionId', 'int'),
+                 ('song', 'str'),
+                 ('status', 'int'),
+                 ('ts', 'timestamp'),
+                 ('userAgent', 'str'),
+                 ('userId', 'int')]
+
+SONG_COLUMNS = [('num_songs', 'int'),
+                ('artist_id', 'str'),
+                ('artist_latitude', 'float'),
+                ('artist_longitude', 'float'),
+                ('artist_location', 'str'),
+                ('artist_name', 'str'),
+                ('song_id', 'str'),
+                ('title', 'str'),
+                ('duration', 'float'),
+                ('year', 'int')]
+
+# parquet types of the redshift column types, ts is epoch milliseconds in the JSON
+PARQUET_TYPES = {'str': pa.string(),
+                 'int': pa.int32(),
+                 'float': pa.float64(),
+                 'timestamp': pa.timestamp('ms')}
+
+
+def get_files(filepath):
+    """Find the JSON files under a directory
+
+    Args:
+        filepath (str): directory of the raw data
+
+    Returns:
+        list: filepaths of the JSON files, sorted
+
+    """
+    return sorted(glob.glob(os.path.join(filepath, '**', '*.json'), recursive=True))
+
+
+def read_records(filepaths):
+    """Parse the JSON records of files with one record per line
+
+    Args:
+        filepaths (list): filepaths of the JSON files
+
+    Returns:
+        list: records as dictionaries
+
+    """
+    records = []
+    for filepath in filepaths:
+        with open(filepath) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def to_frame(records, columns):
+    """Build a dataframe with the columns and types of a staging table
+
+    Missing fields become nulls, and values that do not fit the type of
+    their column, like the empty userId of logged out events, too.
+
+    Args:
+        records (list): records as dictionaries
+        columns (list): (name, type) of every column of the staging table
+
+    Returns:
+        pandas.DataFrame: records with one column per staging column
+
+    """
+    df = pd.DataFrame.from_records(records, columns=[name for name, _ in columns])
+    for name, kind in columns:
+        if kind in ('int', 'timestamp'):
+            df[name] = pd.to_numeric(df[name], errors='coerce').astype('Int64')
+        elif kind == 'float':
+            df[name] = pd.to_numeric(df[name], errors='coerce')
+        else:
+            df[name] = df[name].astype(object).where(df[name].notna(), None)
+    return df
+
+
+def write_csv(df, filepath):
+    """Write a dataframe as a gzip CSV file, without header, nulls as empty fields
+
+    Args:
+        df (pandas.DataFrame): records of a staging table
+        filepath (str): filepath of the file
+
+    """
+    df.to_csv(filepath, header=False, index=False, compression='gzip')
+
+
+def write_parquet(df, filepath, columns):
+    """Write a dataframe as a Parquet file with the types of the staging table
+
+    Args:
+        df (pandas.DataFrame): records of a staging table
+        filepath (str): filepath of the file
+        columns (list): (name, type) of every column of the staging table
+
+    """
+    df = df.copy()
+    for name, kind in columns:
+        if kind == 'timestamp':
+            df[name] = pd.to_datetime(df[name], unit='ms')
+    schema = pa.schema([(name, PARQUET_TYPES[kind]) for name, kind in columns])
+    pq.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False), filepath)
+
+
+def convert_tree(filepath, table, columns, output, fmt, files_per_part):
+    """Convert the JSON files under a directory into files of a staging table
+
+    Every files_per_part JSON files are written as one part, so the many
+    small raw files become a few larger ones.
+
+    Args:
+        filepath (str): directory of the raw data
+        table (str): name of the staging table
+        columns (list): (name, type) of every column of the staging table
+        output (str): directory where the parts of every table are written
+        fmt (str): format of the parts, csv or parquet
+        files_per_part (int): number of JSON files in every part
+
+    Returns:
+        list: filepaths of the JSON files and of the parts written
+
+    """
+    os.makedirs(os.path.join(output, table), exist_ok=True)
+    files, parts = get_files(filepath), []
+    for i in range(0, len(files), files_per_part):
+        df = to_frame(read_records(files[i:i + files_per_part]), columns)
+        if fmt == 'csv':
+            part = os.path.join(output, table, 'part-{:05d}.csv.gz'.format(len(parts)))
+            write_csv(df, part)
+        else:
+            part = os.path.join(output, table, 'part-{:05d}.parquet'.format(len(parts)))
+            write_parquet(df, part, columns)
+        parts.append(part)
+    return files, parts
+
+
+def read_parts(parts, fmt):
+    """Parse the parts of a staging table, as a COPY would
+
+    Args:
+        parts (list): filepaths of the parts
+        fmt (str): format of the parts, csv or parquet
+
+    Returns:
+        int: number of rows read
+
+    """
+    rows = 0
+    for part in parts:
+        if fmt == 'csv':
+            with gzip.open(part, 'rt', newline='') as f:
+                rows += sum(1 for _ in csv.reader(f))
+        else:
+            rows += pq.read_table(part).num_rows
+    return rows
+
+
+def timed(func, *args):
+    """Run a function and time it
+
+    Args:
+        func (function): function to run
+        args: arguments of the function
+
+    Returns:
+        tuple: result of the function and seconds taken
+
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log-data', default=P1_DATA + '/log_data', help='directory of the raw log files')
+    parser.add_argument('--song-data', default=P1_DATA + '/song_data', help='directory of the raw song files')
+    parser.add_argument('--output', default='staging', help='directory where the converted files are written')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='format of the converted files')
+    parser.add_argument('--files-per-part', type=int, default=1000, help='number of JSON files in every converted file')
+    args = parser.parse_args()
+
+    copies = csv_copy_queries if args.format == 'csv' else parquet_copy_queries
+    sources = [(args.log_data, EVENT_COLUMNS), (args.song_data, SONG_COLUMNS)]
+
+    print("{:<15} {:>6} {:>12} {:>12} {:>10} {:>10}".format(
+        "table", "files", "json bytes", "bytes", "json s", args.format + " s"))
+    for table, (filepath, columns), copy in zip(staging_tables, sources, copies):
+        files, parts = convert_tree(filepath, table, columns, args.output, args.format, args.files_per_part)
+        json_rows, json_seconds = timed(lambda: len(read_records(files)))
+        rows, seconds = timed(read_parts, parts, args.format)
+        if rows != json_rows:
+            raise ValueError("{} has {} rows in the JSON files and {} converted".format(table, json_rows, rows))
+        print("{:<15} {:>6} {:>12} {:>12} {:>10.3f} {:>10.3f}".format(
+            table, len(parts),
+            sum(os.path.getsize(f) for f in files), sum(os.path.getsize(p) for p in parts),
+            json_seconds, seconds))
+        with open(os.path.join(args.output, table + '.sql'), 'w') as f:
+            f.write(copy.strip() + '\n')
+
+    print("Upload {} to CONVERTED_DATA in dwh.cfg, then run etl.py --staging-format {}".format(
+        args.output, args.format))
+
+
+if __name__ == "__main__":
+    main()
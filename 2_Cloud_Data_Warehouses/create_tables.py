@@ -1,51 +1,44 @@
-import configparser
-import psycopg2
+import logging
 from sql_queries import create_table_queries, drop_table_queries
+from connection import ConnectionPool, read_config
 
 
-def drop_tables(cur, conn):
+def drop_tables(pool):
     """Drop all the tables in the associated database
 
-    Drop all the tables of the redshift database associated to the
-    arguments cur and conn
+    Drop all the tables of the redshift database the connections
+    of pool are opened to
 
     Args:
-        cur (psycopg2.extensions.cursor): database cursor
-        conn (psycopg2.extensions.connection): database connection
+        pool (connection.ConnectionPool): connections to the cluster
 
     """
     for query in drop_table_queries:
-        cur.execute(query)
-        conn.commit()
+        pool.execute(query, idempotent=True)
 
 
-def create_tables(cur, conn):
+def create_tables(pool):
     """Creates all the tables in the associated database
 
     Creates the staging tables and the tables of the star schema
-    in the associated redshift database accesible by cur and conn
+    in the associated redshift database accesible by pool
 
     Args:
-        cur (psycopg2.extensions.cursor): database cursor
-        conn (psycopg2.extensions.connection): database connection
+        pool (connection.ConnectionPool): connections to the cluster
 
     """
     for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
+        pool.execute(query, idempotent=True)
 
 
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    pool = ConnectionPool(read_config())
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
+    drop_tables(pool)
+    create_tables(pool)
 
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
-
-    conn.close()
+    pool.closeall()
 
 
 if __name__ == "__main__":
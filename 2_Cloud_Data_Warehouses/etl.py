@@ -1,9 +1,20 @@
-import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from sql_queries import copy_table_queries, insert_table_queries, staging_tables, slice_count_select
+from sql_queries import staging_copy_queries, aggregate_refresh_queries, aggregate_table_names
+from sql_queries import aggregate_watermark_update
+from sql_queries import insert_table_names, insert_table_dependencies, merge_table_queries
+from sql_queries import transform_table_queries, transform_table_names, merge_transform_queries
+from sql_queries import watermark_select, watermark_update, staging_events_max_ts
+from sql_queries import staging_events_truncate, staging_songs_truncate
+from s3_manifest import create_manifests, create_new_files_manifest, create_modified_files_manifest
+from connection import ConnectionPool, read_config
+from telemetry import save_run_history, write_report
 
 
-def load_staging_tables(cur, conn):
+def load_staging_tables(pool, queries=copy_table_queries):
     """Extracts song and events data and load it into staging tables in redshift
 
     This function gets from s3 the raw json files which contains data about the
@@ -11,43 +22,260 @@ def load_staging_tables(cur, conn):
     It loads the data into two staging tables in redshift:
     staging_songs and staging_events.
 
+    A COPY is tried again when the connection is lost, as the transforms
+    drop the rows a COPY committed twice.
+
     Args:
-        cur (psycopg2.extensions.cursor): database cursor
-        conn (psycopg2.extensions.connection): database connection
+        pool (connection.ConnectionPool): connections to the cluster
+        queries (list): COPY statements of staging_events and staging_songs
 
     """
-    for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
+    for table, query in zip(staging_tables, queries):
+        pool.execute(query, name=table, idempotent=True, stats=True)
+
 
+def copy_staging_table(pool, table, query):
+    """Load one staging table on a connection of the pool
+
+    Args:
+        pool (connection.ConnectionPool): connections to the cluster
+        table (str): name of the staging table
+        query (str): COPY statement that loads the table
+
+    Returns:
+        tuple: name of the staging table and seconds taken by the COPY
+
+    """
+    start = time.perf_counter()
+    pool.execute(query, name=table, idempotent=True, stats=True)
+    return table, time.perf_counter() - start
 
-def insert_tables(cur, conn):
+
+def load_staging_tables_parallel(pool, queries):
+    """Load the staging tables concurrently, one connection per COPY
+
+    The COPY statements are independent, so the load takes as long as the
+    slowest of them instead of their sum. The time of every table is printed.
+
+    Args:
+        pool (connection.ConnectionPool): connections to the cluster, at
+            least one per staging table
+        queries (list): tuples with the staging table and its COPY statement
+
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        futures = [executor.submit(copy_staging_table, pool, table, query) for table, query in queries]
+        for future in futures:
+            table, elapsed = future.result()
+            print('{} loaded in {:.1f}s'.format(table, elapsed))
+    print('staging tables loaded in {:.1f}s'.format(time.perf_counter() - start))
+
+
+def insert_tables(pool):
     """Extracts data from the staging tables to fill the tables of the star schema
 
     This function gets data from the staging tables and uses it to fill the tables
     of the star schema. Staging tables and tables of the star schema are in the same
-    redshift database, accesible by the to cur and conn arguments.
+    redshift database, accesible by the connections of pool.
+
+    The staging data is first deduplicated into the transform tables,
+    that the inserts read, and the aggregates of songplays are refreshed
+    at the end, then their watermarks.
+
+    Args:
+        pool (connection.ConnectionPool): connections to the cluster
+
+    """
+    for name, query in zip(transform_table_names, transform_table_queries):
+        pool.execute(query, name=name, idempotent=True, stats=True)
+    for name, query in zip(insert_table_names, insert_table_queries):
+        pool.execute(query, name=name, stats=True)
+    for name, query in zip(aggregate_table_names, aggregate_refresh_queries):
+        pool.execute(query, name=name, idempotent=True, stats=True)
+    pool.execute(aggregate_watermark_update, name='aggregate_watermarks', idempotent=True, stats=True)
+
+
+def run_step(pool, name, query, idempotent=False):
+    """Run one statement on a connection of the pool and time it
 
     Args:
-        cur (psycopg2.extensions.cursor): database cursor
-        conn (psycopg2.extensions.connection): database connection
+        pool (connection.ConnectionPool): connections to the cluster
+        name (str): name of the step
+        query (str): statement of the step
+        idempotent (bool): whether the statement can run again after a lost connection
+
+    Returns:
+        tuple: name of the step, start and end time of the statement
 
     """
-    for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
+    start = time.perf_counter()
+    pool.execute(query, name=name, idempotent=idempotent, stats=True)
+    return name, start, time.perf_counter()
+
+
+def run_dag(pool, steps, dependencies, idempotent=()):
+    """Run statements concurrently as soon as the steps they depend on are done
+
+    Args:
+        pool (connection.ConnectionPool): connections to the cluster, one
+            for every step that may run at the same time
+        steps (dict): statement of every step, by name
+        dependencies (dict): names of the steps every step has to wait for
+        idempotent (collection): names of the steps that can run again
+            after a lost connection
+
+    Returns:
+        list: tuples with the name, start and end time of every step, in
+        the order they finished
+
+    """
+    done, timings, running = set(), [], {}
+    with ThreadPoolExecutor(max_workers=pool.maxconn) as executor:
+        while len(done) < len(steps):
+            for name, query in steps.items():
+                if name not in done and name not in running and set(dependencies.get(name, [])) <= done:
+                    running[name] = executor.submit(run_step, pool, name, query, name in idempotent)
+            if not running:
+                raise ValueError("steps {} depend on each other".format(sorted(set(steps) - done)))
+            finished, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, start, end = future.result()
+                del running[name]
+                done.add(name)
+                timings.append((name, start, end))
+    return timings
+
+
+def insert_tables_parallel(pool, queries=insert_table_queries, idempotent=False,
+                           transforms=transform_table_queries):
+    """Fill the tables of the star schema, running independent inserts concurrently
+
+    The transforms that deduplicate the staging data run first, at the same
+    time but for transform_users, which reads transform_plays. Every table
+    then waits for the transforms it reads; songs also waits for artists and
+    songplays for all the dimensions, as their REFERENCES require. The
+    aggregates are refreshed once songplays is loaded, and their watermarks
+    in a single step once all of them are, so concurrent transactions do
+    not write load_watermarks. The start and duration of every statement
+    is printed.
+
+    Args:
+        pool (connection.ConnectionPool): connections to the cluster
+        queries (list): statements that fill songplays, users, songs,
+            artists and time, in the order of insert_table_names
+        idempotent (bool): whether the statements can run again after a
+            lost connection, as merges can
+        transforms (list): statements that fill the transform tables, in
+            the order of transform_table_names
+
+    """
+    steps = dict(zip(transform_table_names, transforms))
+    steps.update(zip(insert_table_names, queries))
+    steps.update(zip(aggregate_table_names, aggregate_refresh_queries))
+    steps['aggregate_watermarks'] = aggregate_watermark_update
+    retried = set(transform_table_names) | set(aggregate_table_names) | {'aggregate_watermarks'}
+    if idempotent:
+        retried |= set(insert_table_names)
+    timings = run_dag(pool, steps, insert_table_dependencies, retried)
+
+    begin = min(start for _, start, _ in timings)
+    for name, start, end in timings:
+        print('{:<20} started at {:>6.1f}s, took {:>6.1f}s'.format(name, start - begin, end - start))
+    print('star schema loaded in {:.1f}s'.format(max(end for _, _, end in timings) - begin))
+
+
+def load_incremental(pool):
+    """Merge into the star schema only the log and song files added since the last run
+
+    The staging tables are emptied, staging_events is loaded with the log
+    files that sort after the last one loaded, and staging_songs with the
+    song files written to s3 since the last one loaded, as recorded in
+    load_watermarks. Every table of the star schema is merged with a delete
+    and insert on its key, so running it again does not duplicate rows, and
+    the keys of the new songs are merged into the ones already there.
+
+    Args:
+        pool (connection.ConnectionPool): connections to the cluster
+
+    """
+    rows = pool.execute(watermark_select, ('staging_events',), idempotent=True, fetch=True)
+    last_key = rows[0][0] if rows else None
+    rows = pool.execute(watermark_select, ('staging_songs',), idempotent=True, fetch=True)
+    last_modified = rows[0][1] if rows else None
+
+    pool.execute(staging_events_truncate, idempotent=True)
+    pool.execute(staging_songs_truncate, idempotent=True)
+    slices = pool.execute(slice_count_select, idempotent=True, fetch=True)[0][0]
+
+    queries = []
+    new_files = create_new_files_manifest('staging_events', slices, last_key)
+    if new_files is None:
+        print('no log files added after {}'.format(last_key))
+    else:
+        queries.append(('staging_events', new_files[0]))
+    new_songs = create_modified_files_manifest('staging_songs', slices, last_modified)
+    if new_songs is None:
+        print('no song files written since {}'.format(last_modified))
+    else:
+        queries.append(('staging_songs', new_songs[0]))
+    if queries:
+        load_staging_tables_parallel(pool, queries)
+    insert_tables_parallel(pool, merge_table_queries, idempotent=True, transforms=merge_transform_queries)
+
+    if new_files is not None:
+        last_ts = pool.execute(staging_events_max_ts, idempotent=True, fetch=True)[0][0]
+        pool.execute(watermark_update, {'source': 'staging_events', 'last_key': new_files[1], 'last_ts': last_ts},
+                     idempotent=True)
+        print('loaded log files up to {}, events up to {}'.format(new_files[1], last_ts))
+    if new_songs is not None:
+        pool.execute(watermark_update, {'source': 'staging_songs', 'last_key': None, 'last_ts': new_songs[1]},
+                     idempotent=True)
+        print('loaded song files written up to {}'.format(new_songs[1]))
 
 
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--serial', action='store_true',
+                      help='run the COPY and INSERT statements one after the other on a single connection')
+    mode.add_argument('--manifest', action='store_true',
+                      help='load the staging tables from manifests balanced over the cluster slices')
+    mode.add_argument('--incremental', action='store_true',
+                      help='merge only the log and song files added since the last run')
+    parser.add_argument('--staging-format', choices=sorted(staging_copy_queries), default='json',
+                        help='format of the staging files, csv and parquet are written by convert_staging.py')
+    parser.add_argument('--report-dir', default='runs',
+                        help='directory of the JSON reports with the telemetry of every run')
+    args = parser.parse_args()
+    if args.staging_format != 'json' and (args.manifest or args.incremental):
+        parser.error('--manifest and --incremental load the raw JSON files')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    config = read_config()
+    pool = ConnectionPool(config, maxconn=config.getint('ETL', 'POOL_SIZE', fallback=8))
+    run_id = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+    mode = ('incremental' if args.incremental else 'serial' if args.serial
+            else 'manifest' if args.manifest else 'parallel') + ' ' + args.staging_format
+    start = time.perf_counter()
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    if args.incremental:
+        load_incremental(pool)
+    elif args.serial:
+        load_staging_tables(pool, staging_copy_queries[args.staging_format])
+        insert_tables(pool)
+    else:
+        queries = list(zip(staging_tables, staging_copy_queries[args.staging_format]))
+        if args.manifest:
+            slices = pool.execute(slice_count_select, idempotent=True, fetch=True)[0][0]
+            queries = create_manifests(slices)
+        load_staging_tables_parallel(pool, queries)
+        insert_tables_parallel(pool)
 
-    conn.close()
+    save_run_history(pool, run_id, mode, pool.history)
+    print('telemetry of run {} written to run_history and {}'.format(
+        run_id, write_report(args.report_dir, run_id, mode, time.perf_counter() - start, pool.history)))
+    pool.closeall()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+import datetime
+import argparse
+from sql_queries import dashboard_queries, aggregate_watermark_select
+from connection import ConnectionPool, read_config
+
+
+def aggregate_is_current(pool, aggregate, end):
+    """Check whether an aggregate has all the plays of a day
+
+    The day of the last play summarized may still be filling up, so only
+    the days before it are complete.
+
+    Args:
+        pool (connection.ConnectionPool): connections to the cluster
+        aggregate (str): name of the aggregate table
+        end (datetime.date): last day read by the dashboard
+
+    Returns:
+        bool: whether the aggregate was refreshed after the plays of that day
+
+    """
+    rows = pool.execute(aggregate_watermark_select, (aggregate,), name='watermark ' + aggregate,
+                        idempotent=True, fetch=True)
+    return bool(rows) and rows[0][0] is not None and rows[0][0] > end
+
+
+def route(pool, metric, start, end, limit=10):
+    """Run a dashboard metric on its aggregate when it is current, on songplays otherwise
+
+    Args:
+        pool (connection.ConnectionPool): connections to the cluster
+        metric (str): name of the metric, a key of dashboard_queries
+        start (datetime.date): first day of the metric
+        end (datetime.date): last day of the metric
+        limit (int): number of rows of the top songs and artists
+
+    Returns:
+        tuple: table read, aggregate or songplays, and rows of the metric
+
+    """
+    aggregate, aggregate_query, base_query = dashboard_queries[metric]
+    params = {'start': start, 'end': end, 'limit': limit}
+    if aggregate_is_current(pool, aggregate, end):
+        return aggregate, pool.execute(aggregate_query, params, name=metric, idempotent=True, fetch=True)
+    return 'songplays', pool.execute(base_query, params, name=metric, idempotent=True, fetch=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('metric', choices=sorted(dashboard_queries))
+    parser.add_argument('start', type=datetime.date.fromisoformat, help='first day, as YYYY-MM-DD')
+    parser.add_argument('end', type=datetime.date.fromisoformat, help='last day, as YYYY-MM-DD')
+    parser.add_argument('--limit', type=int, default=10, help='number of top songs or artists')
+    args = parser.parse_args()
+
+    pool = ConnectionPool(read_config())
+    source, rows = route(pool, args.metric, args.start, args.end, args.limit)
+    print('{} read from {}'.format(args.metric, source))
+    for row in rows:
+        print(*row, sep='\t')
+    pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import json
+import datetime
+import boto3
+from sql_queries import MANIFEST_PATH, staging_tables, staging_data, manifest_copy_queries
+
+
+def split_s3_url(url):
+    """Split an s3 url, as written in dwh.cfg, into bucket and key prefix
+
+    Args:
+        url (str): s3 url, optionally between single quotes
+
+    Returns:
+        tuple: bucket name and key prefix
+
+    """
+    bucket, _, prefix = url.strip("'").replace('s3://', '', 1).partition('/')
+    return bucket, prefix
+
+
+def list_s3_objects(s3, url):
+    """List the data files under an s3 prefix
+
+    Args:
+        s3 (botocore.client.S3): s3 client
+        url (str): s3 url of the prefix
+
+    Returns:
+        list: tuples with the s3 url, the size in bytes and the time, in UTC,
+        every file was written
+
+    """
+    bucket, prefix = split_s3_url(url)
+    files = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Size'] > 0 and not obj['Key'].endswith('/'):
+                modified = obj['LastModified'].astimezone(datetime.timezone.utc).replace(tzinfo=None)
+                files.append(('s3://{}/{}'.format(bucket, obj['Key']), obj['Size'], modified))
+    return files
+
+
+def list_s3_files(s3, url):
+    """List the data files under an s3 prefix with their size
+
+    Args:
+        s3 (botocore.client.S3): s3 client
+        url (str): s3 url of the prefix
+
+    Returns:
+        list: tuples with the s3 url and the size in bytes of every file
+
+    """
+    return [(file_url, size) for file_url, size, _ in list_s3_objects(s3, url)]
+
+
+def balance_files(files, slices):
+    """Split files into one list per slice with about the same number of bytes
+
+    Redshift loads each file on a single slice, so a COPY takes as long as
+    the slice with the most bytes. Files are given, largest first, to the
+    list with the fewest bytes so far.
+
+    Args:
+        files (list): tuples with the s3 url and the size of every file
+        slices (int): number of slices in the cluster
+
+    Returns:
+        list: one list of files per slice
+
+    """
+    groups = [[] for _ in range(slices)]
+    sizes = [0] * slices
+    for url, size in sorted(files, key=lambda f: f[1], reverse=True):
+        i = sizes.index(min(sizes))
+        groups[i].append((url, size))
+        sizes[i] += size
+    return groups
+
+
+def write_manifest(s3, url, groups):
+    """Write a COPY manifest with the files of the balanced lists
+
+    The entries take one file from each list in turn, so every run of
+    as many entries as slices is spread over all the lists.
+
+    Args:
+        s3 (botocore.client.S3): s3 client
+        url (str): s3 url of the manifest
+        groups (list): lists of files given by balance_files
+
+    """
+    entries = []
+    for i in range(max(len(group) for group in groups)):
+        for group in groups:
+            if i < len(group):
+                file_url, size = group[i]
+                entries.append({'url': file_url, 'mandatory': True,
+                                'meta': {'content_length': size}})
+    bucket, key = split_s3_url(url)
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps({'entries': entries}))
+
+
+def create_table_manifest(s3, table, files, slices):
+    """Write the manifest of a staging table with its files balanced over the slices
+
+    Args:
+        s3 (botocore.client.S3): s3 client
+        table (str): name of the staging table
+        files (list): tuples with the s3 url and the size of every file
+        slices (int): number of slices in the cluster
+
+    Returns:
+        str: s3 url of the manifest
+
+    """
+    groups = balance_files(files, slices)
+    sizes = [sum(size for _, size in group) for group in groups]
+    url = '{}/{}.manifest'.format(MANIFEST_PATH.strip("'"), table)
+    write_manifest(s3, url, groups)
+    print('{}: {} files in {} slices, {} to {} bytes per slice'.format(
+        table, len(files), slices, min(sizes), max(sizes)))
+    return url
+
+
+def create_manifests(slices):
+    """Write the manifests of the staging tables and build their COPY statements
+
+    Args:
+        slices (int): number of slices in the cluster
+
+    Returns:
+        list: tuples with the staging table and its manifest COPY statement
+
+    """
+    s3 = boto3.client('s3', region_name='us-west-2')
+    queries = []
+    for table, data, query in zip(staging_tables, staging_data, manifest_copy_queries):
+        url = create_table_manifest(s3, table, list_s3_files(s3, data), slices)
+        queries.append((table, query.format(url)))
+    return queries
+
+
+def create_new_files_manifest(table, slices, last_key):
+    """Write the manifest of the files of a staging table added after last_key
+
+    The log files are named after the day of their events, so the files
+    added since the last load sort after the last file loaded.
+
+    Args:
+        table (str): name of the staging table
+        slices (int): number of slices in the cluster
+        last_key (str): s3 url of the last file loaded, None for a first load
+
+    Returns:
+        tuple: manifest COPY statement and s3 url of the last new file, or
+        None when there are no new files
+
+    """
+    s3 = boto3.client('s3', region_name='us-west-2')
+    i = staging_tables.index(table)
+    files = [f for f in list_s3_files(s3, staging_data[i]) if last_key is None or f[0] > last_key]
+    if not files:
+        return None
+    url = create_table_manifest(s3, table, files, slices)
+    return manifest_copy_queries[i].format(url), max(f[0] for f in files)
+
+
+def create_modified_files_manifest(table, slices, last_modified):
+    """Write the manifest of the files of a staging table written since last_modified
+
+    The song files are not named in the order they are added, so the new
+    ones are found by the time they were written to s3. S3 keeps that time
+    to the second, so the files of the second of last_modified are listed
+    again, which the merges make harmless.
+
+    Args:
+        table (str): name of the staging table
+        slices (int): number of slices in the cluster
+        last_modified (datetime.datetime): time, in UTC, the last file loaded
+            was written, None for a first load
+
+    Returns:
+        tuple: manifest COPY statement and time the last new file was
+        written, or None when there are no new files
+
+    """
+    s3 = boto3.client('s3', region_name='us-west-2')
+    i = staging_tables.index(table)
+    files = [f for f in list_s3_objects(s3, staging_data[i]) if last_modified is None or f[2] >= last_modified]
+    if not files:
+        return None
+    url = create_table_manifest(s3, table, [(file_url, size) for file_url, size, _ in files], slices)
+    return manifest_copy_queries[i].format(url), max(f[2] for f in files)
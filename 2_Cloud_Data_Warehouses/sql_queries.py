@@ -8,6 +8,8 @@ config.read('dwh.cfg')
 LOG_DATA = config.get("S3", "LOG_DATA")
 LOG_PATH = config.get("S3", "LOG_JSONPATH")
 SONG_DATA = config.get("S3", "SONG_DATA")
+MANIFEST_PATH = config.get("S3", "MANIFEST_PATH")
+CONVERTED_DATA = config.get("S3", "CONVERTED_DATA")
 IAM_ROLE = config.get("IAM_ROLE", "ARN")
 
 # DROP TABLES
@@ -19,6 +21,16 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+watermark_table_drop = "DROP TABLE IF EXISTS load_watermarks"
+plays_transform_drop = "DROP TABLE IF EXISTS transform_plays"
+users_transform_drop = "DROP TABLE IF EXISTS transform_users"
+songs_transform_drop = "DROP TABLE IF EXISTS transform_songs"
+artists_transform_drop = "DROP TABLE IF EXISTS transform_artists"
+song_keys_transform_drop = "DROP TABLE IF EXISTS transform_song_keys"
+song_plays_aggregate_drop = "DROP TABLE IF EXISTS agg_daily_song_plays"
+artist_plays_aggregate_drop = "DROP TABLE IF EXISTS agg_daily_artist_plays"
+level_plays_aggregate_drop = "DROP TABLE IF EXISTS agg_daily_level_plays"
+hourly_activity_aggregate_drop = "DROP TABLE IF EXISTS agg_hourly_activity"
 
 # CREATE TABLES
 
@@ -41,7 +53,7 @@ staging_events_table_create = ("""
         status              INT,
         ts                  TIMESTAMP,
         userAgent           VARCHAR,
-        userId              INT
+        userId              INT DISTKEY
 )
 """)
 
@@ -117,6 +129,128 @@ songplay_table_create = ("""
     )
 """)
 
+watermark_table_create = ("""
+    CREATE TABLE IF NOT EXISTS load_watermarks (
+        source              VARCHAR(32) PRIMARY KEY,
+        last_key            VARCHAR(512),
+        last_ts             TIMESTAMP,
+        updated_at          TIMESTAMP
+    )
+    diststyle all;
+""")
+
+# kept when the tables are dropped, so the history of the runs is not lost
+run_history_table_create = ("""
+    CREATE TABLE IF NOT EXISTS run_history (
+        run_id              VARCHAR(32),
+        mode                VARCHAR(32),
+        step                VARCHAR(64),
+        started_at          TIMESTAMP SORTKEY,
+        seconds             FLOAT,
+        row_count           BIGINT,
+        query_id            INT,
+        rows_loaded         BIGINT,
+        bytes_scanned       BIGINT
+    )
+""")
+
+# the staging data deduplicated by natural key, that the tables of the star schema read
+
+plays_transform_create = ("""
+    CREATE TABLE IF NOT EXISTS transform_plays (
+        start_time          TIMESTAMP SORTKEY,
+        user_id             INT DISTKEY,
+        session_id          INT,
+        item_in_session     INT,
+        level               VARCHAR,
+        first_name          VARCHAR,
+        last_name           VARCHAR,
+        gender              VARCHAR,
+        song                VARCHAR,
+        artist              VARCHAR,
+        location            VARCHAR,
+        user_agent          VARCHAR
+    )
+""")
+
+users_transform_create = ("""
+    CREATE TABLE IF NOT EXISTS transform_users (
+        user_id             INT DISTKEY SORTKEY,
+        first_name          VARCHAR(50),
+        last_name           VARCHAR(50),
+        gender              CHAR(1),
+        level               VARCHAR(10)
+    )
+""")
+
+songs_transform_create = ("""
+    CREATE TABLE IF NOT EXISTS transform_songs (
+        song_id             VARCHAR(25) DISTKEY SORTKEY,
+        title               VARCHAR(200),
+        artist_id           VARCHAR(25),
+        year                SMALLINT,
+        duration            FLOAT
+    )
+""")
+
+artists_transform_create = ("""
+    CREATE TABLE IF NOT EXISTS transform_artists (
+        artist_id           VARCHAR(25) DISTKEY SORTKEY,
+        name                VARCHAR(200),
+        location            VARCHAR(200),
+        latitude            FLOAT,
+        longitude           FLOAT
+    )
+""")
+
+song_keys_transform_create = ("""
+    CREATE TABLE IF NOT EXISTS transform_song_keys (
+        title               VARCHAR(200) SORTKEY,
+        artist_name         VARCHAR(200),
+        song_id             VARCHAR(25),
+        artist_id           VARCHAR(25)
+    )
+    diststyle all;
+""")
+
+# summaries of songplays the dashboards read instead of the fact table
+
+song_plays_aggregate_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_daily_song_plays (
+        day                 DATE SORTKEY,
+        song_id             VARCHAR(25) DISTKEY,
+        plays               INT
+    )
+""")
+
+artist_plays_aggregate_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_daily_artist_plays (
+        day                 DATE SORTKEY,
+        artist_id           VARCHAR(25) DISTKEY,
+        plays               INT
+    )
+""")
+
+level_plays_aggregate_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_daily_level_plays (
+        day                 DATE SORTKEY,
+        level               VARCHAR(10),
+        plays               INT,
+        users               INT
+    )
+    diststyle all;
+""")
+
+hourly_activity_aggregate_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_hourly_activity (
+        hour                TIMESTAMP SORTKEY,
+        plays               INT,
+        users               INT,
+        sessions            INT
+    )
+    diststyle all;
+""")
+
 # STAGING TABLES
 
 staging_events_copy = ("""
@@ -132,69 +266,427 @@ staging_songs_copy = ("""
     region 'us-west-2' format as JSON 'auto';
 """).format(SONG_DATA, IAM_ROLE)
 
+# MANIFEST STAGING TABLES
+
+slice_count_select = "SELECT COUNT(*) FROM stv_slices"
+
+staging_events_manifest_copy = ("""
+    COPY staging_events FROM '{{}}'
+        credentials 'aws_iam_role={}'
+        region 'us-west-2' format as JSON {}
+        timeformat as 'epochmillisecs'
+        manifest;
+""").format(IAM_ROLE, LOG_PATH)
+
+staging_songs_manifest_copy = ("""
+    COPY staging_songs FROM '{{}}'
+    credentials 'aws_iam_role={}'
+    region 'us-west-2' format as JSON 'auto'
+    manifest;
+""").format(IAM_ROLE)
+
+# CONVERTED STAGING TABLES
+
+staging_events_csv_copy = ("""
+    COPY staging_events FROM '{}/staging_events/'
+        credentials 'aws_iam_role={}'
+        region 'us-west-2' CSV GZIP
+        emptyasnull
+        timeformat as 'epochmillisecs';
+""").format(CONVERTED_DATA.strip("'"), IAM_ROLE)
+
+staging_songs_csv_copy = ("""
+    COPY staging_songs FROM '{}/staging_songs/'
+    credentials 'aws_iam_role={}'
+    region 'us-west-2' CSV GZIP
+    emptyasnull;
+""").format(CONVERTED_DATA.strip("'"), IAM_ROLE)
+
+staging_events_parquet_copy = ("""
+    COPY staging_events FROM '{}/staging_events/'
+        credentials 'aws_iam_role={}'
+        format as PARQUET;
+""").format(CONVERTED_DATA.strip("'"), IAM_ROLE)
+
+staging_songs_parquet_copy = ("""
+    COPY staging_songs FROM '{}/staging_songs/'
+    credentials 'aws_iam_role={}'
+    format as PARQUET;
+""").format(CONVERTED_DATA.strip("'"), IAM_ROLE)
+
+# STAGING TRANSFORMS
+
+# every transform empties its table with DELETE, as TRUNCATE would commit on
+# Redshift and leave the table empty when the INSERT fails
+
+# the NextSong events, once per user, session and start time. staging_events
+# and transform_plays are both distributed on the user, the first key of the
+# window, so no event moves between slices, and the users and songplays read
+# the result without sorting the events again
+plays_transform_insert = ("""
+DELETE FROM transform_plays;
+
+INSERT INTO transform_plays (start_time, user_id, session_id, item_in_session, level, first_name,
+                             last_name, gender, song, artist, location, user_agent)
+    SELECT  ts, userId, sessionId, itemInSession, level, firstName,
+            lastName, gender, song, artist, location, userAgent
+    FROM (
+        SELECT  ts, userId, sessionId, itemInSession, level, firstName,
+                lastName, gender, song, artist, location, userAgent,
+                ROW_NUMBER() OVER (PARTITION BY userId, sessionId, ts ORDER BY itemInSession) AS n
+        FROM staging_events
+        WHERE userId IS NOT NULL AND page = 'NextSong'
+    ) events
+    WHERE n = 1;
+
+ANALYZE transform_plays;
+""")
+
+users_transform_insert = ("""
+DELETE FROM transform_users;
+
+INSERT INTO transform_users (user_id, first_name, last_name, gender, level)
+    SELECT  user_id, first_name, last_name, gender, level
+    FROM (
+        SELECT  user_id, first_name, last_name, gender, level,
+                ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY start_time DESC) AS n
+        FROM transform_plays
+    ) plays
+    WHERE n = 1;
+
+ANALYZE transform_users;
+""")
+
+songs_transform_insert = ("""
+DELETE FROM transform_songs;
+
+INSERT INTO transform_songs (song_id, title, artist_id, year, duration)
+    SELECT  song_id, title, artist_id, year, duration
+    FROM (
+        SELECT  song_id, title, artist_id, year, duration,
+                ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC) AS n
+        FROM staging_songs
+        WHERE song_id IS NOT NULL
+    ) songs
+    WHERE n = 1;
+
+ANALYZE transform_songs;
+""")
+
+artists_transform_insert = ("""
+DELETE FROM transform_artists;
+
+INSERT INTO transform_artists (artist_id, name, location, latitude, longitude)
+    SELECT  artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+    FROM (
+        SELECT  artist_id, artist_name, artist_location, artist_latitude, artist_longitude,
+                ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name) AS n
+        FROM staging_songs
+        WHERE artist_id IS NOT NULL
+    ) artists
+    WHERE n = 1;
+
+ANALYZE transform_artists;
+""")
+
+song_keys_transform_insert = ("""
+DELETE FROM transform_song_keys;
+
+INSERT INTO transform_song_keys (title, artist_name, song_id, artist_id)
+    SELECT  title, artist_name, song_id, artist_id
+    FROM (
+        SELECT  title, artist_name, song_id, artist_id,
+                ROW_NUMBER() OVER (PARTITION BY title, artist_name ORDER BY song_id) AS n
+        FROM staging_songs
+        WHERE song_id IS NOT NULL
+    ) songs
+    WHERE n = 1;
+
+ANALYZE transform_song_keys;
+""")
+
+# the incremental load stages the new songs only, so their keys are merged
+# into the keys already there, keeping the lowest song_id of every key
+song_keys_transform_merge = ("""
+DELETE FROM transform_song_keys
+    USING staging_songs
+    WHERE transform_song_keys.title = staging_songs.title
+      AND transform_song_keys.artist_name = staging_songs.artist_name
+      AND staging_songs.song_id < transform_song_keys.song_id;
+
+INSERT INTO transform_song_keys (title, artist_name, song_id, artist_id)
+    SELECT  title, artist_name, song_id, artist_id
+    FROM (
+        SELECT  title, artist_name, song_id, artist_id,
+                ROW_NUMBER() OVER (PARTITION BY title, artist_name ORDER BY song_id) AS n
+        FROM staging_songs
+        WHERE song_id IS NOT NULL
+    ) songs
+    WHERE n = 1
+      AND NOT EXISTS (SELECT 1 FROM transform_song_keys k
+                      WHERE k.title = songs.title AND k.artist_name = songs.artist_name);
+
+ANALYZE transform_song_keys;
+""")
+
 # FINAL TABLES
 
 songplay_table_insert = ("""
 INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
-    SELECT  DISTINCT e.ts,
-            e.userId,
-            e.level,
-            s.song_id,
-            s.artist_id,
-            e.sessionId,
-            e.location,
-            e.userAgent
-    FROM staging_events e
-    JOIN staging_songs  s
-    ON (e.song = s.title AND e.artist = s.artist_name)
-    WHERE e.page = 'NextSong'
+    SELECT  p.start_time,
+            p.user_id,
+            p.level,
+            k.song_id,
+            k.artist_id,
+            p.session_id,
+            p.location,
+            p.user_agent
+    FROM transform_plays p
+    JOIN transform_song_keys k
+    ON (p.song = k.title AND p.artist = k.artist_name)
 """)
 
 user_table_insert = ("""
 INSERT INTO users (user_id, first_name, last_name, gender, level)
-    SELECT DISTINCT userId,
-                    firstName,
-                    lastName,
-                    gender,
-                    level
-    FROM staging_events
-    WHERE userId IS NOT NULL AND page = 'NextSong'
+    SELECT user_id, first_name, last_name, gender, level
+    FROM transform_users
 """)
 
 song_table_insert = ("""
 INSERT INTO songs (song_id, title, artist_id, year, duration)
-    SELECT  DISTINCT song_id,
-            title,
-            artist_id,
-            year,
-            duration
-    FROM staging_songs
-    WHERE song_id IS NOT NULL;
+    SELECT song_id, title, artist_id, year, duration
+    FROM transform_songs;
 """)
 
 artist_table_insert = ("""
 INSERT INTO artists (artist_id, name, location, latitude, longitude)
-    SELECT DISTINCT artist_id ,
-                    artist_name,
-                    artist_location,
-                    artist_latitude,
-                    artist_longitude
-    FROM staging_songs
-    where artist_id IS NOT NULL;
+    SELECT artist_id, name, location, latitude, longitude
+    FROM transform_artists;
 """)
 
-time_table_insert = ("""
+# the time units are extracted once per distinct timestamp given by the
+# query in {}, and only the timestamps not in time yet are appended
+time_dimension_insert = ("""
 INSERT INTO time (start_time, hour, day, week, month, year, weekday)
-    SELECT  DISTINCT date_trunc('second', ts),
-            EXTRACT(hour FROM ts),
-            EXTRACT(day FROM ts),
-            EXTRACT(week FROM ts),
-            EXTRACT(month FROM ts),
-            EXTRACT(year FROM ts),
-            EXTRACT(dayofweek FROM ts)
-    FROM staging_events;
+    SELECT  start_time,
+            EXTRACT(hour FROM start_time),
+            EXTRACT(day FROM start_time),
+            EXTRACT(week FROM start_time),
+            EXTRACT(month FROM start_time),
+            EXTRACT(year FROM start_time),
+            EXTRACT(dayofweek FROM start_time)
+    FROM ({}) new_times
+    WHERE start_time NOT IN (SELECT start_time FROM time);
+""")
+
+time_table_insert = time_dimension_insert.format(
+    "SELECT DISTINCT date_trunc('second', ts) AS start_time FROM staging_events WHERE page = 'NextSong'")
+
+# INCREMENTAL MERGES
+
+watermark_select = "SELECT last_key, last_ts FROM load_watermarks WHERE source = %s"
+watermark_update = ("""
+DELETE FROM load_watermarks WHERE source = %(source)s;
+
+INSERT INTO load_watermarks (source, last_key, last_ts, updated_at)
+    VALUES (%(source)s, %(last_key)s, %(last_ts)s, GETDATE());
+""")
+
+staging_events_max_ts = "SELECT MAX(ts) FROM staging_events"
+staging_events_truncate = "TRUNCATE staging_events"
+staging_songs_truncate = "TRUNCATE staging_songs"
+
+# rows of the star schema replaced by the new staging data, deleted before the inserts.
+# A songplay is identified by its user, session and start time, the key
+# transform_plays deduplicates the events on, as songplays has no itemInSession
+
+songplay_table_delete = ("""
+DELETE FROM songplays
+    USING transform_plays
+    WHERE songplays.user_id = transform_plays.user_id
+      AND songplays.session_id = transform_plays.session_id
+      AND songplays.start_time = transform_plays.start_time;
+""")
+
+user_table_delete = ("""
+DELETE FROM users USING transform_users WHERE users.user_id = transform_users.user_id;
+""")
+
+song_table_delete = ("""
+DELETE FROM songs USING transform_songs WHERE songs.song_id = transform_songs.song_id;
+""")
+
+artist_table_delete = ("""
+DELETE FROM artists USING transform_artists WHERE artists.artist_id = transform_artists.artist_id;
+""")
+
+# AGGREGATE REFRESH
+
+# every refresh recomputes the days of the events in staging_events
+
+song_plays_aggregate_refresh = ("""
+DELETE FROM agg_daily_song_plays
+    WHERE day IN (SELECT DISTINCT CAST(ts AS DATE) FROM staging_events WHERE page = 'NextSong');
+
+INSERT INTO agg_daily_song_plays (day, song_id, plays)
+    SELECT CAST(start_time AS DATE), song_id, COUNT(*)
+    FROM songplays
+    WHERE CAST(start_time AS DATE) IN (SELECT DISTINCT CAST(ts AS DATE) FROM staging_events WHERE page = 'NextSong')
+    GROUP BY 1, 2;
+""")
+
+artist_plays_aggregate_refresh = ("""
+DELETE FROM agg_daily_artist_plays
+    WHERE day IN (SELECT DISTINCT CAST(ts AS DATE) FROM staging_events WHERE page = 'NextSong');
+
+INSERT INTO agg_daily_artist_plays (day, artist_id, plays)
+    SELECT CAST(start_time AS DATE), artist_id, COUNT(*)
+    FROM songplays
+    WHERE CAST(start_time AS DATE) IN (SELECT DISTINCT CAST(ts AS DATE) FROM staging_events WHERE page = 'NextSong')
+    GROUP BY 1, 2;
+""")
+
+level_plays_aggregate_refresh = ("""
+DELETE FROM agg_daily_level_plays
+    WHERE day IN (SELECT DISTINCT CAST(ts AS DATE) FROM staging_events WHERE page = 'NextSong');
+
+INSERT INTO agg_daily_level_plays (day, level, plays, users)
+    SELECT CAST(start_time AS DATE), level, COUNT(*), COUNT(DISTINCT user_id)
+    FROM songplays
+    WHERE CAST(start_time AS DATE) IN (SELECT DISTINCT CAST(ts AS DATE) FROM staging_events WHERE page = 'NextSong')
+    GROUP BY 1, 2;
+""")
+
+hourly_activity_aggregate_refresh = ("""
+DELETE FROM agg_hourly_activity
+    WHERE CAST(hour AS DATE) IN (SELECT DISTINCT CAST(ts AS DATE) FROM staging_events WHERE page = 'NextSong');
+
+INSERT INTO agg_hourly_activity (hour, plays, users, sessions)
+    SELECT date_trunc('hour', start_time), COUNT(*), COUNT(DISTINCT user_id), COUNT(DISTINCT session_id)
+    FROM songplays
+    WHERE CAST(start_time AS DATE) IN (SELECT DISTINCT CAST(ts AS DATE) FROM staging_events WHERE page = 'NextSong')
+    GROUP BY 1;
+""")
+
+# records in load_watermarks up to when songplays is summarized by every aggregate,
+# once all of them are refreshed, so a single transaction writes load_watermarks.
+# {} are the names of the aggregates, as a list and as a query
+aggregate_watermarks_upsert = ("""
+DELETE FROM load_watermarks WHERE source IN ({0});
+
+INSERT INTO load_watermarks (source, last_ts, updated_at)
+    SELECT aggregates.source, plays.last_ts, GETDATE()
+    FROM (SELECT MAX(start_time) AS last_ts FROM songplays) plays
+    CROSS JOIN ({1}) aggregates;
+""")
+
+# DASHBOARD QUERIES
+
+# every dashboard query reads the days from %(start)s to %(end)s, both
+# included, from an aggregate or, when the aggregate is behind, from songplays
+
+aggregate_watermark_select = "SELECT CAST(last_ts AS DATE) FROM load_watermarks WHERE source = %s"
+
+top_songs_aggregate = ("""
+SELECT s.title, SUM(a.plays) AS plays
+    FROM agg_daily_song_plays a
+    JOIN songs s ON (a.song_id = s.song_id)
+    WHERE a.day BETWEEN %(start)s AND %(end)s
+    GROUP BY s.title
+    ORDER BY plays DESC
+    LIMIT %(limit)s
+""")
+
+top_songs_base = ("""
+SELECT s.title, COUNT(*) AS plays
+    FROM songplays sp
+    JOIN songs s ON (sp.song_id = s.song_id)
+    WHERE sp.start_time >= %(start)s AND sp.start_time < CAST(%(end)s AS DATE) + 1
+    GROUP BY s.title
+    ORDER BY plays DESC
+    LIMIT %(limit)s
+""")
+
+top_artists_aggregate = ("""
+SELECT ar.name, SUM(a.plays) AS plays
+    FROM agg_daily_artist_plays a
+    JOIN artists ar ON (a.artist_id = ar.artist_id)
+    WHERE a.day BETWEEN %(start)s AND %(end)s
+    GROUP BY ar.name
+    ORDER BY plays DESC
+    LIMIT %(limit)s
+""")
+
+top_artists_base = ("""
+SELECT ar.name, COUNT(*) AS plays
+    FROM songplays sp
+    JOIN artists ar ON (sp.artist_id = ar.artist_id)
+    WHERE sp.start_time >= %(start)s AND sp.start_time < CAST(%(end)s AS DATE) + 1
+    GROUP BY ar.name
+    ORDER BY plays DESC
+    LIMIT %(limit)s
+""")
+
+level_plays_aggregate = ("""
+SELECT day, level, plays, users
+    FROM agg_daily_level_plays
+    WHERE day BETWEEN %(start)s AND %(end)s
+    ORDER BY day, level
+""")
+
+level_plays_base = ("""
+SELECT CAST(start_time AS DATE) AS day, level, COUNT(*) AS plays, COUNT(DISTINCT user_id) AS users
+    FROM songplays
+    WHERE start_time >= %(start)s AND start_time < CAST(%(end)s AS DATE) + 1
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+""")
+
+hourly_activity_aggregate = ("""
+SELECT hour, plays, users, sessions
+    FROM agg_hourly_activity
+    WHERE hour >= %(start)s AND hour < CAST(%(end)s AS DATE) + 1
+    ORDER BY hour
+""")
+
+hourly_activity_base = ("""
+SELECT date_trunc('hour', start_time) AS hour, COUNT(*) AS plays,
+       COUNT(DISTINCT user_id) AS users, COUNT(DISTINCT session_id) AS sessions
+    FROM songplays
+    WHERE start_time >= %(start)s AND start_time < CAST(%(end)s AS DATE) + 1
+    GROUP BY 1
+    ORDER BY 1
+""")
+
+# RUN TELEMETRY
+
+last_query_id_select = "SELECT pg_last_query_id()"
+last_copy_count_select = "SELECT pg_last_copy_count()"
+copy_bytes_select = "SELECT SUM(transfer_size)::BIGINT FROM stl_s3client WHERE query = %s"
+scan_bytes_select = "SELECT SUM(bytes)::BIGINT FROM stl_scan WHERE query = %s AND type = 2"
+
+run_history_insert = ("""
+INSERT INTO run_history (run_id, mode, step, started_at, seconds, row_count, query_id, rows_loaded, bytes_scanned)
+    VALUES {}
 """)
 
+# TABLE DESIGN ADVISOR
+
+explain = "EXPLAIN {}"
+
+table_info_select = ("""
+SELECT "table", diststyle, sortkey1, tbl_rows
+    FROM svv_table_info
+    WHERE schema = 'public'
+""")
+
+result_cache_off = "SET enable_result_cache_for_session TO off"
+
+analyze_compression = "ANALYZE COMPRESSION {}"
+
+advised_table_create = "CREATE TEMP TABLE {}_advised {} AS SELECT * FROM {}"
+advised_table_drop = "DROP TABLE IF EXISTS {}_advised"
+
 # QUERY LISTS
 
 create_table_queries = [staging_events_table_create,
@@ -203,7 +695,18 @@ create_table_queries = [staging_events_table_create,
                         artist_table_create,
                         song_table_create,
                         time_table_create,
-                        songplay_table_create]
+                        songplay_table_create,
+                        watermark_table_create,
+                        run_history_table_create,
+                        plays_transform_create,
+                        users_transform_create,
+                        songs_transform_create,
+                        artists_transform_create,
+                        song_keys_transform_create,
+                        song_plays_aggregate_create,
+                        artist_plays_aggregate_create,
+                        level_plays_aggregate_create,
+                        hourly_activity_aggregate_create]
 
 drop_table_queries = [staging_events_table_drop,
                       staging_songs_table_drop,
@@ -211,14 +714,109 @@ drop_table_queries = [staging_events_table_drop,
                       user_table_drop,
                       song_table_drop,
                       artist_table_drop,
-                      time_table_drop]
+                      time_table_drop,
+                      watermark_table_drop,
+                      plays_transform_drop,
+                      users_transform_drop,
+                      songs_transform_drop,
+                      artists_transform_drop,
+                      song_keys_transform_drop,
+                      song_plays_aggregate_drop,
+                      artist_plays_aggregate_drop,
+                      level_plays_aggregate_drop,
+                      hourly_activity_aggregate_drop]
 
 copy_table_queries = [staging_events_copy,
                       staging_songs_copy]
 
+csv_copy_queries = [staging_events_csv_copy,
+                    staging_songs_csv_copy]
+
+parquet_copy_queries = [staging_events_parquet_copy,
+                        staging_songs_parquet_copy]
+
+staging_copy_queries = {'json': copy_table_queries,
+                        'csv': csv_copy_queries,
+                        'parquet': parquet_copy_queries}
+
+staging_tables = ['staging_events',
+                  'staging_songs']
+
+staging_data = [LOG_DATA,
+                SONG_DATA]
+
+manifest_copy_queries = [staging_events_manifest_copy,
+                         staging_songs_manifest_copy]
+
+transform_table_queries = [plays_transform_insert,
+                           users_transform_insert,
+                           songs_transform_insert,
+                           artists_transform_insert,
+                           song_keys_transform_insert]
+
+merge_transform_queries = [plays_transform_insert,
+                           users_transform_insert,
+                           songs_transform_insert,
+                           artists_transform_insert,
+                           song_keys_transform_merge]
+
+transform_table_names = ['transform_plays',
+                         'transform_users',
+                         'transform_songs',
+                         'transform_artists',
+                         'transform_song_keys']
+
 insert_table_queries = [songplay_table_insert,
                         user_table_insert,
                         song_table_insert,
                         artist_table_insert,
                         time_table_insert]
 
+merge_table_queries = [songplay_table_delete + songplay_table_insert,
+                       user_table_delete + user_table_insert,
+                       song_table_delete + song_table_insert,
+                       artist_table_delete + artist_table_insert,
+                       time_table_insert]
+
+insert_table_names = ['songplays',
+                      'users',
+                      'songs',
+                      'artists',
+                      'time']
+
+# tables each insert has to wait for, following the REFERENCES of the star schema
+# and the transforms each of them reads; the aggregates summarize songplays
+insert_table_dependencies = {'transform_users': ['transform_plays'],
+                             'songplays': ['users', 'songs', 'artists', 'time',
+                                           'transform_plays', 'transform_song_keys'],
+                             'users': ['transform_users'],
+                             'songs': ['artists', 'transform_songs'],
+                             'artists': ['transform_artists'],
+                             'time': [],
+                             'agg_daily_song_plays': ['songplays'],
+                             'agg_daily_artist_plays': ['songplays'],
+                             'agg_daily_level_plays': ['songplays'],
+                             'agg_hourly_activity': ['songplays'],
+                             'aggregate_watermarks': ['agg_daily_song_plays', 'agg_daily_artist_plays',
+                                                      'agg_daily_level_plays', 'agg_hourly_activity']}
+
+aggregate_refresh_queries = [song_plays_aggregate_refresh,
+                             artist_plays_aggregate_refresh,
+                             level_plays_aggregate_refresh,
+                             hourly_activity_aggregate_refresh]
+
+aggregate_table_names = ['agg_daily_song_plays',
+                         'agg_daily_artist_plays',
+                         'agg_daily_level_plays',
+                         'agg_hourly_activity']
+
+aggregate_watermark_update = aggregate_watermarks_upsert.format(
+    ", ".join("'{}'".format(name) for name in aggregate_table_names),
+    " UNION ALL ".join("SELECT '{}' AS source".format(name) for name in aggregate_table_names))
+
+# aggregates the dashboard metrics can be read from, with their query on
+# the aggregate and on songplays
+dashboard_queries = {'top_songs': ('agg_daily_song_plays', top_songs_aggregate, top_songs_base),
+                     'top_artists': ('agg_daily_artist_plays', top_artists_aggregate, top_artists_base),
+                     'plays_by_level': ('agg_daily_level_plays', level_plays_aggregate, level_plays_base),
+                     'hourly_activity': ('agg_hourly_activity', hourly_activity_aggregate, hourly_activity_base)}
@@ -0,0 +1,175 @@
+import os
+import json
+import datetime
+import psycopg2
+from sql_queries import last_query_id_select, last_copy_count_select, copy_bytes_select, scan_bytes_select
+from sql_queries import run_history_insert
+
+# fields of a statement record, in the order of the columns of run_history
+RECORD_FIELDS = ('step', 'started_at', 'seconds', 'row_count', 'query_id', 'rows_loaded', 'bytes_scanned')
+
+
+def split_statements(query):
+    """Split the statements of a step, like a transform ending with ANALYZE
+
+    Args:
+        query (str): SQL statements separated by semicolons
+
+    Returns:
+        list: SQL statements, without the semicolons
+
+    """
+    return [statement.strip() for statement in query.split(';') if statement.strip()]
+
+
+def statement_names(name, statements):
+    """Name every statement of a step after the step and the command it runs
+
+    Args:
+        name (str): name of the step
+        statements (list): SQL statements of the step
+
+    Returns:
+        list: the name of the step for a single statement, otherwise the
+        name of the step and the first word of every statement, as
+        transform_users: INSERT
+
+    """
+    if len(statements) == 1:
+        return [name]
+    return ['{}: {}'.format(name, statement.split()[0].upper()) for statement in statements]
+
+
+def system_tables_available(conn):
+    """Check whether the cluster has the functions the stats are read with
+
+    Redshift has them, a local postgres does not. The check runs in its own
+    transaction, so the statements read their stats inside theirs.
+
+    Args:
+        conn (psycopg2.extensions.connection): connection to the cluster
+
+    Returns:
+        bool: whether pg_last_query_id() can be called
+
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(last_query_id_select)
+        conn.commit()
+        return True
+    except psycopg2.Error:
+        conn.rollback()
+        return False
+
+
+def statement_ids(cur, query):
+    """Read the query id of the last statement of a cursor, in its transaction
+
+    The query id is given by pg_last_query_id(), and a COPY adds the rows it
+    loaded, given by pg_last_copy_count().
+
+    Args:
+        cur (psycopg2.extensions.cursor): cursor the statement ran on
+        query (str): SQL statement
+
+    Returns:
+        dict: query_id of the statement, and rows_loaded for a COPY
+
+    """
+    cur.execute(last_query_id_select)
+    stats = {'query_id': cur.fetchone()[0]}
+    if query.lstrip().upper().startswith('COPY'):
+        cur.execute(last_copy_count_select)
+        stats['rows_loaded'] = cur.fetchone()[0]
+    return stats
+
+
+def statement_bytes(conn, record):
+    """Read from the system tables the bytes a committed statement read
+
+    A COPY reports the bytes it read from s3, other statements the bytes
+    they scanned from the tables. When the system tables are not filled
+    yet, the bytes are left out.
+
+    Args:
+        conn (psycopg2.extensions.connection): connection to the cluster
+        record (dict): record of the statement, with its query_id and, for
+            a COPY, its rows_loaded
+
+    Returns:
+        dict: bytes_scanned of the statement, when available
+
+    """
+    stats = {}
+    try:
+        with conn.cursor() as cur:
+            query = copy_bytes_select if record['rows_loaded'] is not None else scan_bytes_select
+            cur.execute(query, (record['query_id'],))
+            stats['bytes_scanned'] = cur.fetchone()[0]
+        conn.commit()
+    except psycopg2.Error:
+        if not conn.closed:
+            conn.rollback()
+    return stats
+
+
+def new_record(step, started_at, seconds, row_count):
+    """Build the record of a statement, without its system table stats
+
+    Args:
+        step (str): name of the statement
+        started_at (datetime.datetime): UTC time the statement started
+        seconds (float): wall time of the statement
+        row_count (int): rows affected, as reported by the cursor, -1 when unknown
+
+    Returns:
+        dict: record of the statement, with a field for every column of run_history
+
+    """
+    record = dict.fromkeys(RECORD_FIELDS)
+    record.update(step=step, started_at=started_at, seconds=seconds, row_count=row_count)
+    return record
+
+
+def save_run_history(pool, run_id, mode, records):
+    """Insert the records of the statements of a run into run_history
+
+    Args:
+        pool (connection.ConnectionPool): connections to the cluster
+        run_id (str): id of the run
+        mode (str): how the run loaded the tables, as given to etl.py
+        records (list): records of the statements, given by new_record
+
+    """
+    if not records:
+        return
+    values = ', '.join(['(' + ', '.join(['%s'] * (len(RECORD_FIELDS) + 2)) + ')'] * len(records))
+    params = [value for record in records
+              for value in (run_id, mode) + tuple(record[field] for field in RECORD_FIELDS)]
+    pool.execute(run_history_insert.format(values), params, name='run_history')
+
+
+def write_report(path, run_id, mode, seconds, records):
+    """Write the records of the statements of a run as a JSON report
+
+    Args:
+        path (str): directory of the reports, the file is named after the run
+        run_id (str): id of the run
+        mode (str): how the run loaded the tables, as given to etl.py
+        seconds (float): wall time of the whole run
+        records (list): records of the statements, given by new_record
+
+    Returns:
+        str: filepath of the report
+
+    """
+    os.makedirs(path, exist_ok=True)
+    filepath = os.path.join(path, 'run-{}.json'.format(run_id))
+    report = {'run_id': run_id,
+              'mode': mode,
+              'seconds': seconds,
+              'statements': sorted(records, key=lambda record: record['started_at'])}
+    with open(filepath, 'w') as f:
+        json.dump(report, f, indent=4, default=datetime.datetime.isoformat)
+    return filepath
@@ -0,0 +1,386 @@
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import urllib.request
+from datetime import datetime
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import udf, col, lit, when, concat
+from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
+from etl import add_start_time, extract_time_table, process_song_data, process_log_data
+from etl import build_song_lookup, find_skewed_keys, extract_songplays, EVENT_SONG_KEYS
+
+# first event of the generated logs, 2018-11-01 00:00 UTC in milliseconds
+FIRST_TS = 1541030400000
+# generated events are spread over 30 days
+TS_RANGE = 30 * 24 * 3600 * 1000
+
+
+def create_local_spark_session():
+    spark = SparkSession \
+        .builder \
+        .master("local[*]") \
+        .config("spark.sql.shuffle.partitions", "8") \
+        .config("spark.sql.legacy.timeParserPolicy", "LEGACY") \
+        .config("spark.ui.showConsoleProgress", "false") \
+        .getOrCreate()
+    return spark
+
+
+def generate_events(spark, rows):
+    """Generate NextSong log events with the columns used by the time table and songplays
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        rows (int): number of events
+
+    Returns:
+        pyspark.sql.DataFrame: log events, cached so every run reads the same data
+
+    """
+    df = spark.range(rows).select(
+        (lit(FIRST_TS) + col("id") * 7919 % TS_RANGE).alias("ts"),
+        (col("id") % 100).cast("string").alias("userId"),
+        lit("free").alias("level"),
+        (col("id") % 1000).alias("sessionId"),
+        lit("NextSong").alias("page")
+    )
+    return df.cache()
+
+
+def udf_time_table(df):
+    """Build the time table as etl.py did, with python UDFs returning strings
+
+    Args:
+        df (pyspark.sql.DataFrame): log events
+
+    Returns:
+        tuple: log events with the timestamp column and the time table
+
+    """
+    get_timestamp = udf(lambda x: str(int(x) // 1000))
+    df = df.withColumn("timestamp", get_timestamp(col("ts")))
+    get_datetime = udf(lambda x: str(datetime.fromtimestamp(int(x) / 1000)))
+    df = df.withColumn("datetime", get_datetime(col("ts")))
+    time_table = df.select(
+        col('timestamp').alias('start_time'),
+        hour('datetime').alias('hour'),
+        dayofmonth('datetime').alias('day'),
+        weekofyear('datetime').alias('week'),
+        month('datetime').alias('month'),
+        year('datetime').alias('year'),
+        date_format('datetime', 'u').cast('int').alias('weekday')
+    )
+    return df.withColumnRenamed("timestamp", "start_time"), time_table
+
+
+def native_time_table(df):
+    """Build the time table as etl.py does, with native column expressions
+
+    Args:
+        df (pyspark.sql.DataFrame): log events
+
+    Returns:
+        tuple: log events with the start_time column and the time table
+
+    """
+    df = add_start_time(df)
+    return df, extract_time_table(df)
+
+
+def run_benchmark(events, build, output):
+    """Write the time table and the events joined to it, as process_log_data does, and time it
+
+    Args:
+        events (pyspark.sql.DataFrame): log events given by generate_events
+        build (function): udf_time_table or native_time_table
+        output (str): directory where the parquet files are written
+
+    Returns:
+        float: elapsed seconds
+
+    """
+    start = time.perf_counter()
+    df, time_table = build(events)
+    time_table.write.parquet(output + "/time_table.parquet", mode="overwrite")
+    joined = df.join(time_table, "start_time").select("start_time", "userId", "level", "sessionId", "year", "month")
+    joined.write.parquet(output + "/songplays_table.parquet", mode="overwrite")
+    return time.perf_counter() - start
+
+
+BENCHMARKS = [
+    ("python UDFs", udf_time_table),
+    ("native expressions", native_time_table),
+]
+
+
+def generate_input_data(path, song_files, log_files, events_per_file=300):
+    """Write raw data trees like the ones of the udacity bucket, one song per file
+
+    Args:
+        path (str): directory where song_data and log_data are written
+        song_files (int): number of song files
+        log_files (int): number of log files, one per day
+        events_per_file (int): number of events in every log file
+
+    """
+    rng = random.Random(0)
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    for i in range(song_files):
+        track = "TR{:016d}".format(i)
+        directory = os.path.join(path, "song_data", *(rng.choice(letters) for _ in range(3)))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track + ".json"), "w") as f:
+            json.dump({"num_songs": 1, "artist_id": "AR{:06d}".format(i % 500),
+                       "artist_latitude": None, "artist_longitude": None, "artist_location": "",
+                       "artist_name": "Artist {}".format(i % 500), "song_id": "SO{:016d}".format(i),
+                       "title": "Song {}".format(i), "duration": 180 + i % 120, "year": 1990 + i % 30}, f)
+    os.makedirs(os.path.join(path, "log_data"), exist_ok=True)
+    for day in range(log_files):
+        with open(os.path.join(path, "log_data", "events-{:03d}.json".format(day)), "w") as f:
+            for item in range(events_per_file):
+                i = rng.randrange(song_files)
+                ts = FIRST_TS + day * 86400000 + item * 1000
+                f.write(json.dumps({"artist": "Artist {}".format(i % 500), "auth": "Logged In",
+                                    "firstName": "Ann", "gender": "F", "itemInSession": item,
+                                    "lastName": "Lee", "length": 180 + i % 120, "level": "free",
+                                    "location": "Here", "method": "PUT", "page": "NextSong",
+                                    "registration": 1540000000000.0, "sessionId": day, "song": "Song {}".format(i),
+                                    "status": 200, "ts": ts, "userAgent": "Mozilla",
+                                    "userId": str(item % 50)}) + "\n")
+
+
+def stage_total(spark, metric):
+    """Sum a metric of the completed stages of the application
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        metric (str): name of the metric in the stages of the UI API, as shuffleWriteBytes
+
+    Returns:
+        int: total of the metric so far
+
+    """
+    url = "{}/api/v1/applications/{}/stages?status=complete".format(
+        spark.sparkContext.uiWebUrl, spark.sparkContext.applicationId)
+    with urllib.request.urlopen(url) as response:
+        return sum(stage[metric] for stage in json.load(response))
+
+
+def run_job(spark, input_data, output_data, infer_schema, strict):
+    """Run process_song_data and process_log_data, and measure their time and records read
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        input_data (str): directory of the raw data
+        output_data (str): directory where the tables are written
+        infer_schema (bool): infer the schema of the JSON files instead of using the declared ones
+        strict (bool): fail on malformed records instead of writing them under corrupt_records
+
+    Returns:
+        tuple: elapsed seconds and records read from the files
+
+    """
+    before = stage_total(spark, "inputRecords")
+    start = time.perf_counter()
+    process_song_data(spark, input_data, output_data, strict=strict, infer_schema=infer_schema)
+    process_log_data(spark, input_data, output_data, strict=strict, infer_schema=infer_schema)
+    elapsed = time.perf_counter() - start
+    # the UI gets the stages of the job asynchronously
+    time.sleep(2)
+    return elapsed, stage_total(spark, "inputRecords") - before
+
+
+READ_BENCHMARKS = [
+    ("inferred schema", True, False),
+    ("declared schema", False, False),
+    ("declared schema, strict", False, True),
+]
+
+
+def generate_song_tables(spark, songs):
+    """Generate songs and artists tables where titles and artist names are shared
+
+    Every title is used by 10 songs and every artist name by 2 artists,
+    as popular titles and names are in the song data.
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        songs (int): number of songs
+
+    Returns:
+        tuple: songs and artists tables
+
+    """
+    songs_table = spark.range(songs).select(
+        concat(lit("SO"), col("id")).alias("song_id"),
+        concat(lit("Song "), col("id") % (songs // 10)).alias("title"),
+        concat(lit("AR"), col("id") % 1000).alias("artist_id"),
+        lit(2000).alias("year"),
+        (lit(120.0) + col("id") / 10).alias("duration")
+    )
+    artists_table = spark.range(1000).select(
+        concat(lit("AR"), col("id")).alias("artist_id"),
+        concat(lit("Artist "), col("id") % 500).alias("name"),
+        lit("").alias("location"),
+        lit(None).cast("double").alias("latitude"),
+        lit(None).cast("double").alias("longitude")
+    )
+    return songs_table.cache(), artists_table.cache()
+
+
+def generate_song_events(spark, rows, songs):
+    """Generate NextSong events of the songs of generate_song_tables
+
+    A fifth of the events play the same song, and a tenth have a length
+    that matches no song.
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        rows (int): number of events
+        songs (int): number of songs
+
+    Returns:
+        pyspark.sql.DataFrame: log events with a start_time column
+
+    """
+    song = when(col("id") % 5 == 0, lit(0)).otherwise(col("id") * 7919 % songs)
+    df = spark.range(rows).select(
+        (lit(FIRST_TS) + col("id") * 7919 % TS_RANGE).alias("ts"),
+        concat(lit("Song "), song % (songs // 10)).alias("song"),
+        concat(lit("Artist "), song % 1000 % 500).alias("artist"),
+        (lit(120.0) + song / 10 + when(col("id") % 10 == 1, lit(0.05)).otherwise(lit(0.0))).alias("length"),
+        (col("id") % 100).cast("string").alias("userId"),
+        lit("free").alias("level"),
+        (col("id") % 1000).alias("sessionId"),
+        lit("Here").alias("location"),
+        lit("Mozilla").alias("userAgent")
+    )
+    return add_start_time(df).cache()
+
+
+def title_join_songplays(spark, df, songs_table, artists_table):
+    """Build the songplays table as etl.py did, joining on the title and on the artist name apart
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        df (pyspark.sql.DataFrame): log events with a start_time column
+        songs_table (pyspark.sql.DataFrame): songs table
+        artists_table (pyspark.sql.DataFrame): artists table
+
+    Returns:
+        pyspark.sql.DataFrame: songplays table
+
+    """
+    songs_table.createOrReplaceTempView("songs_table")
+    artists_table.createOrReplaceTempView("artists_table")
+    extract_time_table(df).createOrReplaceTempView("time_table")
+    df.createOrReplaceTempView("log_table")
+    return spark.sql("""
+        SELECT monotonically_increasing_id() AS songplay_id,
+               time_table.start_time, log_table.userId, log_table.level,
+               songs_table.song_id, songs_table.artist_id, log_table.sessionId,
+               log_table.location, log_table.userAgent, time_table.year, time_table.month
+        FROM log_table
+        JOIN songs_table ON log_table.song = songs_table.title
+        JOIN artists_table ON log_table.artist = artists_table.name
+        JOIN time_table ON time_table.start_time = log_table.start_time
+    """)
+
+
+def keyed_join_songplays(spark, df, songs_table, artists_table):
+    """Build the songplays table as etl.py does, with the broadcast song lookup
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        df (pyspark.sql.DataFrame): log events with a start_time column
+        songs_table (pyspark.sql.DataFrame): songs table
+        artists_table (pyspark.sql.DataFrame): artists table
+
+    Returns:
+        pyspark.sql.DataFrame: songplays table
+
+    """
+    return extract_songplays(spark, df, build_song_lookup(songs_table, artists_table))
+
+
+def run_join(spark, tables, build, output):
+    """Write the songplays table and measure its rows, time and shuffle bytes
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        tables (tuple): events, songs and artists tables
+        build (function): title_join_songplays or keyed_join_songplays
+        output (str): directory where the parquet files are written
+
+    Returns:
+        tuple: rows written, elapsed seconds and shuffle bytes written
+
+    """
+    before = stage_total(spark, "shuffleWriteBytes")
+    start = time.perf_counter()
+    build(spark, *tables).write.parquet(output + "/songplays_table.parquet", mode="overwrite",
+                                        partitionBy=["year", "month"])
+    elapsed = time.perf_counter() - start
+    # the UI gets the stages of the job asynchronously
+    time.sleep(2)
+    shuffled = stage_total(spark, "shuffleWriteBytes") - before
+    return spark.read.parquet(output + "/songplays_table.parquet").count(), elapsed, shuffled
+
+
+JOIN_BENCHMARKS = [
+    ("title and name joins", title_join_songplays),
+    ("keyed broadcast join", keyed_join_songplays),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", nargs="?", choices=["time", "read", "join"], default="time",
+                        help="time table expressions, reading the JSON files with and without inference, "
+                             "or the songplays join")
+    parser.add_argument("--songs", type=int, default=20000, help="number of generated songs of the join")
+    parser.add_argument("--rows", type=int, default=1000000, help="number of generated events")
+    parser.add_argument("--song-files", type=int, default=5000, help="number of generated song files")
+    parser.add_argument("--runs", type=int, default=3, help="runs of every mode, the fastest is kept")
+    args = parser.parse_args()
+
+    spark = create_local_spark_session()
+    spark.sparkContext.setLogLevel("ERROR")
+
+    with tempfile.TemporaryDirectory() as output:
+        if args.benchmark == "time":
+            print("{:<24} {:>10} {:>10} {:>12}".format("mode", "rows", "seconds", "rows/sec"))
+            events = generate_events(spark, args.rows)
+            events.count()
+            for name, build in BENCHMARKS:
+                elapsed = min(run_benchmark(events, build, output) for _ in range(args.runs))
+                print("{:<24} {:>10} {:>10.2f} {:>12.0f}".format(name, args.rows, elapsed, args.rows / elapsed))
+        elif args.benchmark == "join":
+            # no automatic broadcast, as of a song catalogue larger than the threshold
+            spark.conf.set("spark.sql.autoBroadcastJoinThreshold", -1)
+            songs_table, artists_table = generate_song_tables(spark, args.songs)
+            events = generate_song_events(spark, args.rows, args.songs)
+            events.count()
+            for row in find_skewed_keys(events, EVENT_SONG_KEYS):
+                print("skewed song key {}: {} events".format(tuple(row)[:-1], row["count"]))
+            print("{:<24} {:>10} {:>10} {:>10} {:>14}".format("mode", "events", "rows", "seconds", "shuffle bytes"))
+            for name, build in JOIN_BENCHMARKS:
+                rows, elapsed, shuffled = run_join(spark, (events, songs_table, artists_table), build, output)
+                print("{:<24} {:>10} {:>10} {:>10.2f} {:>14}".format(name, args.rows, rows, elapsed, shuffled))
+        else:
+            input_data = output + "/input/"
+            generate_input_data(input_data, args.song_files, 30)
+            print("{:<24} {:>10} {:>10} {:>12} {:>14}".format("mode", "files", "seconds", "files/sec",
+                                                               "records read"))
+            for name, infer_schema, strict in READ_BENCHMARKS:
+                elapsed, records = min(run_job(spark, input_data, output + "/tables/", infer_schema, strict)
+                                       for _ in range(args.runs))
+                print("{:<24} {:>10} {:>10.2f} {:>12.0f} {:>14}".format(
+                    name, args.song_files, elapsed, args.song_files / elapsed, records))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import uuid
+from pyspark.sql.functions import col, input_file_name, lit, regexp_extract, to_date
+from etl import create_spark_session, read_json, drop_corrupt_records, SONG_SCHEMA, EVENT_SCHEMA, COMPACTION_RUN
+
+# schema of the raw records of every source and the column their compacted files are partitioned by
+SOURCES = {
+    "song_data": (SONG_SCHEMA, "letter"),
+    "log_data": (EVENT_SCHEMA, "date")
+}
+
+
+def list_files(spark, path):
+    """List the JSON files under a directory and its subdirectories
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        path (str): directory, local or on S3
+
+    Returns:
+        list: paths of the JSON files, sorted
+
+    """
+    jvm = spark.sparkContext._jvm
+    directory = jvm.org.apache.hadoop.fs.Path(path)
+    fs = directory.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    files, iterator = [], fs.listFiles(directory, True)
+    while iterator.hasNext():
+        name = iterator.next().getPath().toString()
+        if name.endswith(".json"):
+            files.append(name)
+    return sorted(files)
+
+
+def compacted_files(spark, manifest):
+    """Get the raw files already compacted, as recorded in the manifest of a source
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        manifest (str): path of the manifest
+
+    Returns:
+        set: paths of the raw files compacted, empty on the first run
+
+    """
+    jvm = spark.sparkContext._jvm
+    path = jvm.org.apache.hadoop.fs.Path(manifest)
+    if not path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()).exists(path):
+        return set()
+    return {row.filename for row in spark.read.parquet(manifest).collect()}
+
+
+def add_partition_column(df, source):
+    """Add the column the compacted files of a source are partitioned by
+
+    Songs are partitioned by the first letter of their directory in the raw
+    tree, events by the day they happened.
+
+    Args:
+        df (pyspark.sql.DataFrame): raw records of the source
+        source (str): song_data or log_data
+
+    Returns:
+        pyspark.sql.DataFrame: records with the partition column
+
+    """
+    if source == "song_data":
+        return df.withColumn("letter", regexp_extract(input_file_name(), r"song_data/([^/]+)/", 1))
+    return df.withColumn("date", to_date((col("ts") / 1000).cast("timestamp")))
+
+
+def compact_source(spark, input_data, output_data, source, fmt="parquet", max_records=1000000):
+    """Compact the raw files of a source added since the last run into a few large files
+
+    The new raw files are read with their declared schema and appended to
+    output_data/compacted/<source>, one file per partition value, up to
+    max_records records each, with the id of the run. They are then appended
+    to the manifest with the same id, so the next run skips them. A run that
+    fails between both writes leaves records that etl.read_compacted does not
+    read, and the next run appends those files again.
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        input_data (str): path of the raw data
+        output_data (str): path of the compacted layer, and of the tables
+        source (str): song_data or log_data
+        fmt (str): format of the compacted files, parquet or json (JSON Lines)
+        max_records (int): maximum number of records in every compacted file
+
+    Returns:
+        int: number of raw files compacted
+
+    """
+    schema, partition = SOURCES[source]
+    manifest = output_data + "compacted/_manifests/" + source
+    done = compacted_files(spark, manifest)
+    new_files = [f for f in list_files(spark, input_data + source) if f not in done]
+    if not new_files:
+        return 0
+
+    run = uuid.uuid4().hex
+    # the partition of a song comes from its file, known until the records are persisted
+    records = add_partition_column(read_json(spark, new_files, schema), source)
+    df = drop_corrupt_records(records, output_data + "compacted/corrupt_records/" + source)
+    df.withColumn(COMPACTION_RUN, lit(run)) \
+        .repartition(partition) \
+        .write \
+        .format(fmt) \
+        .partitionBy(partition) \
+        .option("maxRecordsPerFile", max_records) \
+        .mode("append") \
+        .save(output_data + "compacted/" + source)
+    records.unpersist()
+
+    spark.createDataFrame([(f, run) for f in new_files], ["filename", COMPACTION_RUN]) \
+        .coalesce(1) \
+        .write \
+        .parquet(manifest, mode="append")
+    return len(new_files)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--format", choices=["parquet", "json"], default="parquet",
+                        help="format of the compacted files, json writes JSON Lines")
+    parser.add_argument("--max-records-per-file", type=int, default=1000000,
+                        help="maximum number of records in every compacted file")
+    args = parser.parse_args()
+
+    spark = create_spark_session()
+    input_data = "s3a://udacity-dend/"
+    output_data = "s3a://udacity-dend-spark/"
+
+    # To test on local data which is faster
+    # input_data = "/home/workspace/data/"
+    # output_data = "/home/workspace/data/"
+
+    for source in SOURCES:
+        files = compact_source(spark, input_data, output_data, source, args.format, args.max_records_per_file)
+        print("{}: {} new files compacted".format(source, files))
+
+
+if __name__ == "__main__":
+    main()
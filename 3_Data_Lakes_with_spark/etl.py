@@ -1,9 +1,11 @@
 import configparser
-from datetime import datetime
+import argparse
 import os
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col
-from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
+from pyspark.sql.functions import col, input_file_name, avg, desc, when
+from pyspark.sql.functions import year, month, dayofmonth, dayofweek, hour, weekofyear
+from pyspark.sql.types import StructType, StructField, StringType, LongType, DoubleType
 
 
 config = configparser.ConfigParser()
@@ -12,6 +14,54 @@ config.read('dl.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
+# schemas of the song and event records, so the JSON files are read once
+# instead of once more to infer them
+SONG_SCHEMA = StructType([
+    StructField("num_songs", LongType()),
+    StructField("artist_id", StringType()),
+    StructField("artist_latitude", DoubleType()),
+    StructField("artist_longitude", DoubleType()),
+    StructField("artist_location", StringType()),
+    StructField("artist_name", StringType()),
+    StructField("song_id", StringType()),
+    StructField("title", StringType()),
+    StructField("duration", DoubleType()),
+    StructField("year", LongType())
+])
+
+EVENT_SCHEMA = StructType([
+    StructField("artist", StringType()),
+    StructField("auth", StringType()),
+    StructField("firstName", StringType()),
+    StructField("gender", StringType()),
+    StructField("itemInSession", LongType()),
+    StructField("lastName", StringType()),
+    StructField("length", DoubleType()),
+    StructField("level", StringType()),
+    StructField("location", StringType()),
+    StructField("method", StringType()),
+    StructField("page", StringType()),
+    StructField("registration", DoubleType()),
+    StructField("sessionId", LongType()),
+    StructField("song", StringType()),
+    StructField("status", LongType()),
+    StructField("ts", LongType()),
+    StructField("userAgent", StringType()),
+    StructField("userId", StringType())
+])
+
+# column with the raw text of the records that do not match their schema
+CORRUPT_RECORD = "_corrupt_record"
+# column with the file of those records
+CORRUPT_FILE = "filename"
+
+# column of the compacted records with the compact.py run that wrote them
+COMPACTION_RUN = "run"
+
+# columns of the events that identify their song, and of the song lookup they match
+EVENT_SONG_KEYS = ["song", "artist", "length"]
+LOOKUP_SONG_KEYS = ["title", "artist_name", "duration"]
+
 
 def create_spark_session():
     spark = SparkSession \
@@ -21,12 +71,230 @@ def create_spark_session():
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def read_json(spark, path, schema, strict=False):
+    """Read JSON records with their declared schema
+
+    Strict mode fails on the first record that is not valid JSON or does
+    not match the schema. Otherwise those records are kept, with null fields,
+    their raw text in the CORRUPT_RECORD column and their file in the
+    CORRUPT_FILE one, as the file is not known any more once they are persisted.
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        path (str): path of the JSON files
+        schema (pyspark.sql.types.StructType): schema of the records, None to infer it
+        strict (bool): fail on malformed records instead of keeping them
+
+    Returns:
+        pyspark.sql.DataFrame: records read
+
+    """
+    if schema is None:
+        df = spark.read.json(path)
+    elif strict:
+        return spark.read.json(path, schema=schema, mode="FAILFAST")
+    else:
+        schema = StructType(schema.fields + [StructField(CORRUPT_RECORD, StringType())])
+        df = spark.read.json(path, schema=schema, mode="PERMISSIVE", columnNameOfCorruptRecord=CORRUPT_RECORD)
+    if CORRUPT_RECORD not in df.columns:
+        return df
+    return df.withColumn(CORRUPT_FILE, when(col(CORRUPT_RECORD).isNotNull(), input_file_name()))
+
+
+def drop_corrupt_records(df, output):
+    """Write the records read as corrupt, with their file, and leave them out of the data
+
+    df is persisted first, unless it already is, so finding the corrupt
+    records and building the tables from the others read the files once.
+    Every record is then checked against the whole schema. The caller
+    unpersists df after its last use.
+
+    Args:
+        df (pyspark.sql.DataFrame): records given by read_json
+        output (str): path where the corrupt records are written as JSON
+
+    Returns:
+        pyspark.sql.DataFrame: records that match the schema
+
+    """
+    if CORRUPT_RECORD not in df.columns:
+        return df
+    if not df.is_cached:
+        df.persist(StorageLevel.MEMORY_AND_DISK)
+    df.filter(col(CORRUPT_RECORD).isNotNull()).write.json(output, mode="overwrite")
+    return df.filter(col(CORRUPT_RECORD).isNull()).drop(CORRUPT_RECORD, CORRUPT_FILE)
+
+
+def read_compacted(spark, output_data, source, schema, fmt):
+    """Read the records of a source from the compacted layer written by compact.py
+
+    Only the records of the runs recorded in the manifest of the source are
+    read. A run that fails after appending its records and before recording
+    its raw files leaves them out, and the next run compacts those files again.
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        output_data (str): path of the compacted layer, and of the tables
+        source (str): song_data or log_data
+        schema (pyspark.sql.types.StructType): schema of the records
+        fmt (str): format of the compacted files, parquet or json
+
+    Returns:
+        pyspark.sql.DataFrame: records read, with the partition column of the layer
+
+    """
+    manifest = spark.read.parquet(output_data + "compacted/_manifests/" + source)
+    runs = [row[COMPACTION_RUN] for row in manifest.select(COMPACTION_RUN).distinct().collect()]
+    schema = StructType(schema.fields + [StructField(COMPACTION_RUN, StringType())])
+    return spark.read.format(fmt).schema(schema).load(output_data + "compacted/" + source) \
+        .filter(col(COMPACTION_RUN).isin(runs)) \
+        .drop(COMPACTION_RUN)
+
+
+def add_start_time(df):
+    """Add the start_time of the log events, as a timestamp, from their ts in milliseconds
+
+    Args:
+        df (pyspark.sql.DataFrame): log events
+
+    Returns:
+        pyspark.sql.DataFrame: log events with a start_time column
+
+    """
+    return df.withColumn("start_time", (col("ts") / 1000).cast("timestamp"))
+
+
+def extract_time_table(df):
+    """Break down the start_time of the log events into time units
+
+    Weekday goes from 1 on Mondays to 7 on Sundays.
+
+    Args:
+        df (pyspark.sql.DataFrame): log events with a start_time column
+
+    Returns:
+        pyspark.sql.DataFrame: one row per event with the columns of the time table
+
+    """
+    return df.select(
+        col('start_time'),
+        hour('start_time').alias('hour'),
+        dayofmonth('start_time').alias('day'),
+        weekofyear('start_time').alias('week'),
+        month('start_time').alias('month'),
+        year('start_time').alias('year'),
+        ((dayofweek('start_time') + 5) % 7 + 1).alias('weekday')
+    )
+
+
+def build_song_lookup(songs_table, artists_table):
+    """Build the lookup of the song and artist ids by title, artist name and duration
+
+    Args:
+        songs_table (pyspark.sql.DataFrame): songs table
+        artists_table (pyspark.sql.DataFrame): artists table
+
+    Returns:
+        pyspark.sql.DataFrame: one row per title, artist name and duration
+
+    """
+    return songs_table.join(artists_table, "artist_id") \
+        .select("title", col("name").alias("artist_name"), "duration", "song_id", "artist_id") \
+        .dropDuplicates(LOOKUP_SONG_KEYS)
+
+
+def find_skewed_keys(df, keys, factor=100, top=10):
+    """Find the join keys with many more rows than the average key
+
+    Args:
+        df (pyspark.sql.DataFrame): rows to join
+        keys (list): names of the join columns
+        factor (int): times the average number of rows per key a key needs to be reported
+        top (int): maximum number of keys reported
+
+    Returns:
+        list: rows with the values of the keys and their number of rows, the largest first
+
+    """
+    counts = df.groupBy(*keys).count()
+    average = counts.agg(avg("count")).first()[0]
+    if average is None:
+        return []
+    return counts.filter(col("count") > factor * average).orderBy(desc("count")).limit(top).collect()
+
+
+def extract_songplays(spark, df, song_lookup, keep_unmatched=False):
+    """Match the events with their song and artist to build the songplays table
+
+    The lookup has one row per key, so every event gives at most one
+    songplay, and it is broadcast, so the events are not shuffled.
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        df (pyspark.sql.DataFrame): NextSong events with a start_time column
+        song_lookup (pyspark.sql.DataFrame): lookup given by build_song_lookup
+        keep_unmatched (bool): keep the events whose song is not in the lookup,
+            with null song_id and artist_id
+
+    Returns:
+        pyspark.sql.DataFrame: songplays table
+
+    """
+    song_lookup.createOrReplaceTempView("song_lookup")
+    df.createOrReplaceTempView("log_table")
+
+    return spark.sql("""
+        SELECT /*+ BROADCAST(song_lookup) */
+               monotonically_increasing_id() AS songplay_id,
+               log_table.start_time, 
+               log_table.userId, 
+               log_table.level,     
+               song_lookup.song_id, 
+               song_lookup.artist_id,            
+               log_table.sessionId, 
+               log_table.location, 
+               log_table.userAgent,
+               year(log_table.start_time) AS year, 
+               month(log_table.start_time) AS month           
+        FROM log_table
+        {} JOIN song_lookup 
+            ON log_table.song = song_lookup.title
+           AND log_table.artist = song_lookup.artist_name
+           AND log_table.length = song_lookup.duration
+    """.format("LEFT" if keep_unmatched else "INNER"))
+
+
+def process_song_data(spark, input_data, output_data, persist=False, strict=False, infer_schema=False,
+                      compacted=None):
+    """Build the songs and artists tables from the song data and write them
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        input_data (str): path of the raw data
+        output_data (str): path where the tables are written
+        persist (bool): keep the parsed song data in memory, so both tables
+            and the songplays lookup are built from a single read of the files
+        strict (bool): fail on malformed records, see read_json
+        infer_schema (bool): infer the schema from the files instead of SONG_SCHEMA
+        compacted (str): format of the compacted layer to read instead of the
+            raw files, see compact.py
+
+    Returns:
+        tuple: songs and artists tables
+
+    """
     # get filepath to song data file
     song_data = input_data + 'song_data/*/*/*/*.json'
     
     # read song data file
-    df = spark.read.json(song_data)
+    if compacted:
+        df = read_compacted(spark, output_data, "song_data", SONG_SCHEMA, compacted)
+    else:
+        df = read_json(spark, song_data, None if infer_schema else SONG_SCHEMA, strict)
+    if persist:
+        df = df.persist(StorageLevel.MEMORY_AND_DISK)
+    records = df
+    df = drop_corrupt_records(df, output_data + "corrupt_records/song_data")
 
     # extract columns to create songs table
     songs_table = df.select("song_id", 
@@ -54,16 +322,54 @@ def process_song_data(spark, input_data, output_data):
         output_data + "artists_table.parquet", mode="overwrite"
     )
 
+    # kept for the songplays of the run in single-pass mode
+    if not persist:
+        records.unpersist()
+
+    return songs_table, artists_table
+
+
+def process_log_data(spark, input_data, output_data, songs_table=None, artists_table=None, persist=False,
+                     strict=False, infer_schema=False, compacted=None, keep_unmatched=False, skew_report=False):
+    """Build the users, time and songplays tables from the log data and write them
+
+    Args:
+        spark (pyspark.sql.SparkSession): spark session
+        input_data (str): path of the raw data
+        output_data (str): path where the tables are written
+        songs_table (pyspark.sql.DataFrame): songs table of this run, read
+            back from output_data when not given
+        artists_table (pyspark.sql.DataFrame): artists table of this run, read
+            back from output_data when not given
+        persist (bool): keep the NextSong events in memory, so the three
+            tables are built from a single read of the files
+        strict (bool): fail on malformed records, see read_json
+        infer_schema (bool): infer the schema from the files instead of EVENT_SCHEMA
+        compacted (str): format of the compacted layer to read instead of the
+            raw files, see compact.py
+        keep_unmatched (bool): keep in songplays the events whose song is unknown
+        skew_report (bool): print the song keys of the events far more frequent than
+            the average one, before the join
 
-def process_log_data(spark, input_data, output_data):
+    """
     # get filepath to log data file
     log_data = input_data + 'log_data'
 
     # read log data file
-    df = spark.read.json(log_data)
+    if compacted:
+        df = read_compacted(spark, output_data, "log_data", EVENT_SCHEMA, compacted)
+    else:
+        df = read_json(spark, log_data, None if infer_schema else EVENT_SCHEMA, strict)
     
-    # filter by actions for song plays
-    df = df.filter("page = 'NextSong'")
+    # filter by actions for song plays, keeping the corrupt records to report them
+    if CORRUPT_RECORD in df.columns:
+        df = df.filter("page = 'NextSong' OR {} IS NOT NULL".format(CORRUPT_RECORD))
+    else:
+        df = df.filter("page = 'NextSong'")
+    if persist:
+        df = df.persist(StorageLevel.MEMORY_AND_DISK)
+    records = df
+    df = drop_corrupt_records(df, output_data + "corrupt_records/log_data")
     
     # extract columns for users table    
     
@@ -79,24 +385,11 @@ def process_log_data(spark, input_data, output_data):
         output_data + "users_table.parquet", mode="overwrite"
     )    
 
-    # create timestamp column from original timestamp column
-    get_timestamp = udf(lambda x: str(int(x) // 1000))
-    df = df.withColumn("timestamp", get_timestamp(col("ts")))
-
-    # create datetime column from original timestamp column
-    get_datetime = udf(lambda x: str(datetime.fromtimestamp(int(x) / 1000)))
-    df = df.withColumn("datetime", get_datetime(col("ts")))
+    # create start_time column from original timestamp column
+    df = add_start_time(df)
     
     # extract columns to create time table
-    time_table = df.select(
-         col('timestamp').alias('start_time'),
-         hour('datetime').alias('hour'),
-         dayofmonth('datetime').alias('day'),
-         weekofyear('datetime').alias('week'),
-         month('datetime').alias('month'),
-         year('datetime').alias('year'),
-         date_format('datetime', 'u').cast('int').alias('weekday')
-     )
+    time_table = extract_time_table(df)
     
     # write time table to parquet files partitioned by year and month
     time_table.write.parquet(
@@ -104,34 +397,16 @@ def process_log_data(spark, input_data, output_data):
     )   
 
     # read in song data to use for songplays table
-    song_df = spark.read.parquet(output_data + 'songs_table.parquet')
-    artist_df = spark.read.parquet(output_data + 'artists_table.parquet')
-    song_df.createOrReplaceTempView("songs_table")
-    artist_df.createOrReplaceTempView("artists_table")
-    time_table.createOrReplaceTempView("time_table")
-    df.createOrReplaceTempView("log_table")
+    if songs_table is None:
+        songs_table = spark.read.parquet(output_data + 'songs_table.parquet')
+    if artists_table is None:
+        artists_table = spark.read.parquet(output_data + 'artists_table.parquet')
 
     # extract columns from joined song and log datasets to create songplays table 
-    songplays_table = spark.sql("""
-        SELECT monotonically_increasing_id() AS songplay_id,
-               time_table.start_time, 
-               log_table.userId, 
-               log_table.level,     
-               songs_table.song_id, 
-               songs_table.artist_id,            
-               log_table.sessionId, 
-               log_table.location, 
-               log_table.userAgent,
-               time_table.year, 
-               time_table.month           
-        FROM log_table
-        JOIN songs_table 
-            ON log_table.song = songs_table.title
-        JOIN artists_table 
-            ON log_table.artist = artists_table.name 
-        JOIN time_table 
-            ON time_table.start_time = log_table.timestamp
-    """)
+    if skew_report:
+        for row in find_skewed_keys(df, EVENT_SONG_KEYS):
+            print("skewed song key {}: {} events".format(tuple(row)[:-1], row["count"]))
+    songplays_table = extract_songplays(spark, df, build_song_lookup(songs_table, artists_table), keep_unmatched)
 
     # write songplays table to parquet files partitioned by year and month
     songplays_table.write.parquet(
@@ -139,9 +414,28 @@ def process_log_data(spark, input_data, output_data):
         mode="overwrite",
         partitionBy=["year", "month"]
     )
+    records.unpersist()
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--single-pass", action="store_true",
+                        help="read every input once and keep it in memory, building the songplays "
+                             "from the song tables of the run instead of reading them back from S3")
+    parser.add_argument("--strict", action="store_true",
+                        help="fail on the first malformed record instead of writing it under corrupt_records")
+    parser.add_argument("--infer-schema", action="store_true",
+                        help="infer the schema of the JSON files instead of using the declared ones")
+    parser.add_argument("--compacted", choices=["parquet", "json"],
+                        help="read the compacted layer written by compact.py in this format instead of the raw files")
+    parser.add_argument("--keep-unmatched", action="store_true",
+                        help="keep in songplays the events whose song is not in the song data")
+    parser.add_argument("--skew-report", action="store_true",
+                        help="print the songs played far more often than the average one before the join")
+    args = parser.parse_args()
+    options = {"strict": args.strict, "infer_schema": args.infer_schema, "compacted": args.compacted}
+    join_options = {"keep_unmatched": args.keep_unmatched, "skew_report": args.skew_report}
+
     spark = create_spark_session()
     input_data = "s3a://udacity-dend/"
     output_data = "s3a://udacity-dend-spark/"
@@ -150,8 +444,14 @@ def main():
     # input_data = "/home/workspace/data/"
     # output_data = "/home/workspace/data/"
     
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    if args.single_pass:
+        songs_table, artists_table = process_song_data(spark, input_data, output_data, persist=True, **options)
+        process_log_data(spark, input_data, output_data, songs_table, artists_table, persist=True,
+                         **options, **join_options)
+        spark.catalog.clearCache()
+    else:
+        process_song_data(spark, input_data, output_data, **options)    
+        process_log_data(spark, input_data, output_data, **options, **join_options)
 
 
 if __name__ == "__main__":
@@ -92,7 +92,7 @@ load_time_dimension_table = LoadDimensionOperator(
     redshift_conn_id = redshift_conn,
     table = 'time',
     sql_query = SqlQueries.time_table_insert,     
-    truncate = True,      
+    truncate = False,      
     dag=dag
 )
 
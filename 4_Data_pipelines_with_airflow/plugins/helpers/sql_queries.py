@@ -35,8 +35,10 @@ class SqlQueries:
         FROM staging_songs
     """)
 
+    # time units extracted once per distinct start time, appending only the ones not in time yet
     time_table_insert = ("""
         SELECT start_time, extract(hour from start_time), extract(day from start_time), extract(week from start_time), 
                extract(month from start_time), extract(year from start_time), extract(dayofweek from start_time)
-        FROM songplays
+        FROM (SELECT DISTINCT start_time FROM songplays) new_times
+        WHERE start_time NOT IN (SELECT start_time FROM time)
     """)
\ No newline at end of file